@@ -0,0 +1,111 @@
+# app/aggregates.py
+
+import datetime
+import logging
+from typing import Optional
+
+from .db import OutletSalesMonthly, PastryWasteDaily
+
+logger = logging.getLogger(__name__)
+
+# The target categories of the product groups; other groups (add-ons) have no goal.
+TARGET_CATEGORIES = {
+    'Whole Bean/Teas': 'beans',
+    'Beverages': 'beverage',
+    'Food': 'food',
+    'Merchandise': 'merchandise',
+}
+
+
+def category_case(column: str) -> str:
+    """
+    Return the SQL expression mapping a product group column to its target category, NULL for other groups.
+    """
+    cases = ' '.join(f"WHEN '{group}' THEN '{category}'" for group, category in TARGET_CATEGORIES.items())
+    return f'CASE {column} {cases} END'
+
+
+# The statements deleting and rebuilding the aggregates of the months from $1
+# up to, not including, $2. Days are assigned to their month through the dates
+# calendar, and by their own date where the calendar does not cover them.
+OUTLET_SALES_MONTHLY_REFRESH = ('''DELETE FROM outlet_sales_monthly WHERE month >= $1 AND month < $2''',
+                                '''INSERT INTO outlet_sales_monthly (sales_outlet_id, month, year_id, month_name, category,
+                                                                  quantity, line_item_amount, goal)
+                    WITH sold AS (
+                        SELECT r.sales_outlet_id,
+                               COALESCE(MAKE_DATE(d.year_id, d.month_id, 1),
+                                        CAST(DATE_TRUNC('month', r.sales_date) AS DATE)) AS month,
+                               {category} AS category, r.quantity, r.line_item_amount
+                        FROM product_sales_daily r
+                        JOIN product p ON p.product_id = r.product_id
+                        LEFT JOIN dates d ON d.transaction_date = r.sales_date
+                        WHERE r.sales_date >= $1 AND r.sales_date < $2
+                    ), actual AS (
+                        SELECT sales_outlet_id, month, COALESCE(category, 'total') AS category,
+                               SUM(quantity) AS quantity, SUM(line_item_amount) AS line_item_amount
+                        FROM sold
+                        WHERE category IS NOT NULL
+                        GROUP BY GROUPING SETS ((sales_outlet_id, month, category), (sales_outlet_id, month))
+                    ), goals AS (
+                        SELECT t.sales_outlet_id, t.year_month AS month, g.category, g.goal
+                        FROM sales_targets t
+                        CROSS JOIN LATERAL (VALUES ('beans', t.beans_goal), ('beverage', t.beverage_goal),
+                                                   ('food', t.food_goal), ('merchandise', t.merchandise_goal),
+                                                   ('total', t.total_goal)) AS g (category, goal)
+                        WHERE t.year_month >= $1 AND t.year_month < $2
+                    )
+                    SELECT sales_outlet_id, month,
+                           COALESCE(d.year_id, EXTRACT(YEAR FROM month)),
+                           COALESCE(d.month_name, TO_CHAR(month, 'FMMonth')),
+                           category, COALESCE(a.quantity, 0), COALESCE(a.line_item_amount, 0), g.goal
+                    FROM actual a
+                    FULL JOIN goals g USING (sales_outlet_id, month, category)
+                    LEFT JOIN dates d ON d.transaction_date = month'''.format(category=category_case('p.product_group')))
+
+PASTRY_WASTE_DAILY_REFRESH = ('''DELETE FROM pastry_waste_daily WHERE sales_date >= $1 AND sales_date < $2''',
+                              '''INSERT INTO pastry_waste_daily (sales_date, sales_outlet_id, week_desc, start_of_day,
+                                                                quantity_sold, waste, waste_percent)
+                    SELECT i.transaction_date, i.sales_outlet_id,
+                           COALESCE(MIN(d.week_desc), 'Week ' || EXTRACT(WEEK FROM i.transaction_date)),
+                           SUM(i.start_of_day), SUM(i.quantity_sold), SUM(i.waste),
+                           ROUND(100.0 * SUM(i.waste) / NULLIF(SUM(i.start_of_day), 0), 2)
+                    FROM pastry_inventory i
+                    LEFT JOIN dates d ON d.transaction_date = i.transaction_date
+                    WHERE i.transaction_date >= $1 AND i.transaction_date < $2
+                    GROUP BY i.transaction_date, i.sales_outlet_id''')
+
+# The aggregates, with the statements rebuilding them.
+aggregate_tables = [(OutletSalesMonthly, OUTLET_SALES_MONTHLY_REFRESH),
+                    (PastryWasteDaily, PASTRY_WASTE_DAILY_REFRESH)]
+
+
+async def refresh_aggregates(raw_connection: object, first: Optional[datetime.date] = None,
+                             stop: Optional[datetime.date] = None, tables: Optional[list] = None) -> None:
+    """
+    Rebuild the aggregates of the months from `first` up to, not including, `stop`.
+
+    Run after every ingest for all months, and after posted receipts for
+    their months. Each aggregate is rebuilt in one transaction, so readers
+    see either the old or the new rows. Refreshes of the same aggregate wait
+    for each other, so they never insert the same rows twice.
+
+    Args:
+        raw_connection (object): The asyncpg connection.
+        first (datetime.date): The first day of the first month; all months by default.
+        stop (datetime.date): The first day after the last month; all months by default.
+        tables (list): The aggregate table objects to rebuild; all by default.
+
+    Returns:
+        None
+    """
+    first = first or datetime.date.min
+    stop = stop or datetime.date.max
+    for table, (delete, insert) in aggregate_tables:
+        if tables is not None and table not in tables:
+            continue
+        tablename = table.Meta.tablename
+        async with raw_connection.transaction():
+            await raw_connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', tablename)
+            await raw_connection.execute(delete, first, stop)
+            await raw_connection.execute(insert, first, stop)
+        logger.debug('Refreshed %s from %s to %s', tablename, first, stop)
@@ -0,0 +1,267 @@
+# app/backends.py
+
+import asyncio
+import logging
+from datetime import date
+from typing import AsyncIterator, Optional
+
+import asyncpg
+
+from . import common, metrics
+from .cache import bump_generation
+from .columnar import ColumnarStore
+from .common import CustomerSegment, Granularity, TargetCategory
+from .config import settings
+from .db import spawn_task
+from .ingest import INGEST_CHANNEL, TableProgress, ingest_files, ingest_progress, read_ingest_state
+
+logger = logging.getLogger(__name__)
+
+# The seconds between attempts to listen again after the listening connection was lost, at most.
+LISTEN_RETRY_DELAY = 5.0
+
+
+class PostgresBackend:
+    """
+    Answers the endpoint queries with SQL against PostgreSQL, into which the
+    dataset is ingested by `python -m app.ingest`.
+
+    The API processes only read: they follow the ingests through the
+    ingest_state table and the notifications on INGEST_CHANNEL. When the
+    listening connection is lost, e.g. on a database restart, notifications
+    may have been missed: the caches are invalidated and the ingest state
+    re-read once listening again.
+
+    Attributes:
+        database (object): The database connection pool.
+        files (list): The (table object, CSV file path) pairs of the dataset.
+        listener (object): The asyncpg connection listening on INGEST_CHANNEL once started.
+        refresh (asyncio.Task): The last re-read of the ingest state.
+        reconnect (asyncio.Task): The attempts to listen again after the listener was lost, if any.
+    """
+    uses_database = True
+
+    def __init__(self, database: object):
+        self.database = database
+        self.files = []
+        self.listener = None
+        self.refresh = None
+        self.reconnect = None
+
+    async def load(self, files: list) -> bool:
+        """
+        Ingest the dataset files, see ingest_files.
+
+        Args:
+            files (list): The (table object, CSV file path) pairs.
+
+        Returns:
+            bool: True if every file was loaded.
+        """
+        return await ingest_files(files)
+
+    async def start(self, files: list) -> bool:
+        """
+        Report the ingest state of the dataset files in ingest_progress, and
+        keep it and the caches up to date with later ingests.
+
+        Args:
+            files (list): The (table object, CSV file path) pairs.
+
+        Returns:
+            bool: True if every file has been ingested.
+        """
+        self.files = files
+        await self.listen()
+        return await read_ingest_state(files)
+
+    async def listen(self) -> None:
+        """
+        Open the connection listening on INGEST_CHANNEL.
+        """
+        listener = await asyncpg.connect(str(self.database.url))
+        listener.add_termination_listener(self.lost)
+        await listener.add_listener(INGEST_CHANNEL, self.ingested)
+        self.listener = listener
+
+    def lost(self, connection: object) -> None:
+        """
+        Called when the listening connection is closed: listen again unless the backend was stopped.
+        """
+        if connection is not self.listener:
+            return
+        logger.warning('Lost the connection listening on %s', INGEST_CHANNEL)
+        self.listener = None
+        self.reconnect = spawn_task(self.listen_again())
+
+    async def listen_again(self) -> None:
+        """
+        Listen again, retrying until the database is back, then catch up with
+        the ingests that may have been missed meanwhile.
+        """
+        delay = 0.1
+        while True:
+            try:
+                await self.listen()
+                break
+            except (OSError, asyncpg.PostgresError) as error:
+                logger.warning('Listening on %s failed, retrying in %.1fs: %s', INGEST_CHANNEL, delay, error)
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, LISTEN_RETRY_DELAY)
+        logger.info('Listening on %s again', INGEST_CHANNEL)
+        bump_generation()
+        try:
+            await read_ingest_state(self.files)
+        except Exception:
+            logger.exception('Reading the ingest state failed')
+
+    def ingested(self, connection: object, pid: int, channel: str, tablename: str) -> None:
+        """
+        Called when another process committed an ingest: invalidate the caches and re-read the ingest state.
+        """
+        logger.info('%s was ingested by process %d', tablename, pid)
+        bump_generation()
+        self.refresh = spawn_task(read_ingest_state(self.files))
+
+    async def stop(self) -> None:
+        if self.reconnect is not None:
+            self.reconnect.cancel()
+            self.reconnect = None
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            await listener.close()
+
+    async def get_birthday_customer(self, today: Optional[date] = None) -> list:
+        return await common.get_birthday_customer(self.database, today=today)
+
+    async def top_selling_products(self, year: int, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                                   outlet_id: Optional[int] = None, product_category: Optional[str] = None,
+                                   granularity: Optional[Granularity] = None) -> list:
+        return await common.top_selling_products(year, self.database, start_date=start_date, end_date=end_date,
+                                                 outlet_id=outlet_id, product_category=product_category,
+                                                 granularity=granularity)
+
+    async def last_order_per_customer(self, after_customer_id: Optional[int] = None, limit: Optional[int] = None) -> list:
+        return await common.last_order_per_customer(self.database, after_customer_id=after_customer_id, limit=limit)
+
+    def stream_last_order_per_customer(self, after_customer_id: Optional[int] = None,
+                                       limit: Optional[int] = None) -> AsyncIterator[bytes]:
+        return common.stream_last_order_per_customer(self.database, after_customer_id=after_customer_id, limit=limit)
+
+    async def outlet_sales_vs_target(self, year: int, month: Optional[int] = None, outlet_id: Optional[int] = None,
+                                     category: Optional[TargetCategory] = None) -> list:
+        return await common.outlet_sales_vs_target(year, self.database, month=month, outlet_id=outlet_id,
+                                                   category=category)
+
+    async def pastry_waste(self, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                           outlet_id: Optional[int] = None) -> list:
+        return await common.pastry_waste(self.database, start_date=start_date, end_date=end_date, outlet_id=outlet_id)
+
+    async def customer_rfm(self, segment: Optional[CustomerSegment] = None, min_monetary: Optional[float] = None,
+                           inactive_days: Optional[int] = None, after_customer_id: Optional[int] = None,
+                           limit: Optional[int] = None) -> list:
+        return await common.customer_rfm(self.database, segment=segment, min_monetary=min_monetary,
+                                         inactive_days=inactive_days, after_customer_id=after_customer_id, limit=limit)
+
+
+class ColumnarBackend:
+    """
+    Answers the endpoint queries from an in-memory ColumnarStore built from the
+    dataset files, without a database.
+
+    Until the files are loaded, the queries answer with empty results. The
+    outlet reports and the customer RFM table are served from the database only.
+
+    Attributes:
+        store (ColumnarStore): The loaded data, or None.
+    """
+    uses_database = False
+
+    def __init__(self, store: Optional[ColumnarStore] = None):
+        self.store = store
+
+    async def load(self, files: list) -> bool:
+        """
+        Build the store from the dataset files in a worker thread, tracking progress in ingest_progress.
+
+        The time spent on every file is exported as a load_<table> startup phase.
+
+        Args:
+            files (list): The (table object, CSV file path) pairs.
+
+        Returns:
+            bool: True if every file was loaded.
+        """
+        ingest_progress.clear()
+        for table, csv_file in files:
+            ingest_progress[table.Meta.tablename] = TableProgress(csv_file)
+        try:
+            self.store = await asyncio.to_thread(ColumnarStore.from_files, dict(files), ingest_progress)
+        except Exception as error:
+            logger.exception('Loading the columnar store failed')
+            for progress in ingest_progress.values():
+                if not progress.done:
+                    progress.finish('failed', error=f'{type(error).__name__}: {error}')
+            return False
+        for tablename, progress in ingest_progress.items():
+            if progress.status == 'loaded':
+                metrics.startup_phase_duration.set(progress.as_dict()['seconds'], f'load_{tablename}')
+        bump_generation()
+        return True
+
+    async def start(self, files: list) -> bool:
+        """
+        Load the dataset files, see load. Every process holds its own store.
+        """
+        return await self.load(files)
+
+    async def stop(self) -> None:
+        pass
+
+    async def get_birthday_customer(self, today: Optional[date] = None) -> list:
+        if self.store is None:
+            return []
+        with metrics.query_duration.time('get_birthday_customer'):
+            return self.store.get_birthday_customer(today or common.local_today())
+
+    async def top_selling_products(self, year: int, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                                   outlet_id: Optional[int] = None, product_category: Optional[str] = None,
+                                   granularity: Optional[Granularity] = None) -> list:
+        if self.store is None:
+            return []
+        with metrics.query_duration.time('top_selling_products'):
+            return self.store.top_selling_products(year, start_date=start_date, end_date=end_date, outlet_id=outlet_id,
+                                                   product_category=product_category, granularity=granularity)
+
+    async def last_order_per_customer(self, after_customer_id: Optional[int] = None, limit: Optional[int] = None) -> list:
+        if self.store is None:
+            return []
+        with metrics.query_duration.time('last_order_per_customer'):
+            return self.store.last_order_per_customer(after_customer_id=after_customer_id, limit=limit)
+
+    async def stream_last_order_per_customer(self, after_customer_id: Optional[int] = None,
+                                             limit: Optional[int] = None) -> AsyncIterator[bytes]:
+        if self.store is None:
+            return
+        # The store is immutable once loaded: a reload swaps in a new one.
+        for chunk in self.store.stream_last_order_per_customer(after_customer_id=after_customer_id, limit=limit):
+            yield chunk
+
+
+def make_backend(database: object, name: str = None) -> object:
+    """
+    Create the backend selected by settings.backend.
+
+    Args:
+        database (object): The database connection pool, used by the postgres backend.
+        name (str): The backend name, postgres or columnar; defaults to settings.backend.
+
+    Returns:
+        object: The backend.
+    """
+    name = name or settings.backend
+    if name == 'postgres':
+        return PostgresBackend(database)
+    if name == 'columnar':
+        return ColumnarBackend()
+    raise ValueError(f'Unknown backend {name!r}, expected postgres or columnar')
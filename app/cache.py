@@ -0,0 +1,161 @@
+# app/cache.py
+
+import collections
+import hashlib
+from typing import Awaitable, Callable, Hashable, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from . import metrics
+from .config import settings
+from .derived import load_listeners
+
+# Incremented whenever data is loaded; cached values of an older generation are stale.
+data_generation = 0
+
+
+def bump_generation(*args) -> None:
+    """
+    Mark every cached value as stale. Used as a load listener, so it accepts
+    and ignores the (table, columns, batch) arguments.
+
+    Returns:
+        None
+    """
+    global data_generation
+    data_generation += 1
+
+
+load_listeners.append(bump_generation)
+
+
+class CachedResponse:
+    """
+    A serialized JSON response body with its ETag.
+
+    Attributes:
+        body (bytes): The JSON body.
+        etag (str): The entity tag of the body.
+        generation (int): The data generation the body was built from.
+    """
+    __slots__ = ('body', 'etag', 'generation')
+
+    def __init__(self, body: bytes, generation: int):
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.generation = generation
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of serialized responses, keyed by endpoint and parameters.
+
+    Entries built from an older data generation are treated as misses.
+
+    Attributes:
+        max_size (int): The maximum number of cached responses.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that had to build the response.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        """
+        Return the cached response for a key if it is still current.
+
+        Args:
+            key (Hashable): The endpoint and its parameters.
+
+        Returns:
+            CachedResponse: The cached response, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.generation != data_generation:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, body: bytes, generation: int) -> CachedResponse:
+        """
+        Cache a response body, evicting the least recently used entries beyond max_size.
+
+        Args:
+            key (Hashable): The endpoint and its parameters.
+            body (bytes): The JSON body.
+            generation (int): The data generation the body was built from.
+
+        Returns:
+            CachedResponse: The cached response.
+        """
+        entry = CachedResponse(body, generation)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        """
+        Drop every cached response.
+        """
+        self.entries.clear()
+
+
+response_cache = ResponseCache(settings.response_cache_size)
+
+metrics.Counter('response_cache_lookups_total', 'Response cache lookups by result.', ('result',),
+                function=lambda: {('hit',): response_cache.hits, ('miss',): response_cache.misses})
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Tell whether the request's If-None-Match header matches an ETag.
+
+    Args:
+        request (Request): The request.
+        etag (str): The current ETag.
+
+    Returns:
+        bool: True if the client already has this version.
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+async def cached_response(request: Request, key: Hashable, build: Callable[[], Awaitable[object]]) -> Response:
+    """
+    Answer a request from the response cache, building and caching the payload on a miss.
+
+    Args:
+        request (Request): The request.
+        key (Hashable): The endpoint name followed by its parameters.
+        build (Callable): Coroutine function returning the payload.
+
+    Returns:
+        Response: The JSON response with an ETag header, or 304 Not Modified.
+    """
+    entry = response_cache.get(key)
+    cache_status = 'HIT'
+    if entry is None:
+        cache_status = 'MISS'
+        generation = data_generation
+        payload = await build()
+        with metrics.response_encode_duration.time(key[0]):
+            body = JSONResponse(content=jsonable_encoder(payload)).body
+        entry = response_cache.put(key, body, generation)
+
+    headers = {'ETag': entry.etag, 'X-Cache': cache_status}
+    if etag_matches(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type='application/json', headers=headers)
@@ -0,0 +1,326 @@
+# app/columnar.py
+
+import datetime
+import logging
+import time
+from datetime import date
+from typing import Iterator, Optional
+
+import numpy
+
+from .common import MAX_YEAR, MIN_YEAR, STREAM_PREFETCH, Granularity, last_order_line, prepared_chunks
+from .config import settings
+from .db import Customer, Dates, Product, Sales
+
+logger = logging.getLogger(__name__)
+
+# The columns kept in memory, by table.
+COLUMNS = {
+    Customer: ('customer_id', 'customer_first_name', 'customer_email', 'birth_month', 'birth_day'),
+    Product: ('product_id', 'product', 'product_category'),
+    Dates: ('transaction_date', 'week_desc', 'month_name', 'quarter_name'),
+    Sales: ('transaction_id', 'transaction_date', 'transaction_datetime', 'sales_outlet_id', 'customer_id',
+            'product_id', 'quantity'),
+}
+
+
+def read_columns(table: object, csv_file: str, progress=None) -> dict:
+    """
+    Read the kept columns of a CSV file into NumPy arrays.
+
+    The file is read through prepared_chunks, so it is prepared exactly as for
+    the database and its snapshot is used when there is one.
+
+    Args:
+        table (object): The table object the file holds.
+        csv_file (str): The path to the CSV file.
+        progress (Callable): Called with the rows read and the bytes read so far after every chunk.
+
+    Returns:
+        dict: An array per column name.
+    """
+    parts = {name: [] for name in COLUMNS[table]}
+    rows = 0
+    for frame, bytes_read in prepared_chunks(table, csv_file, settings.ingest_batch_size):
+        for name in parts:
+            parts[name].append(frame[name].to_numpy())
+        rows += len(frame)
+        if progress is not None:
+            progress(rows, bytes_read)
+    return {name: numpy.concatenate(arrays) if arrays else numpy.empty(0) for name, arrays in parts.items()}
+
+
+def day_numbers(values: numpy.ndarray) -> numpy.ndarray:
+    """
+    Convert dates or datetimes to days since the epoch.
+    """
+    return values.astype('datetime64[D]').astype(numpy.int64)
+
+
+def lookup(sorted_ids: numpy.ndarray, ids: numpy.ndarray) -> numpy.ndarray:
+    """
+    Return the position of every id in an array of sorted ids, -1 for the ids that are missing.
+    """
+    if not len(sorted_ids):
+        return numpy.full(len(ids), -1)
+    position = numpy.minimum(numpy.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return numpy.where(sorted_ids[position] == ids, position, -1)
+
+
+def fallback_label(granularity: Granularity, day: date) -> str:
+    """
+    Compute the period label of a day the dates calendar does not cover,
+    as period_labels does in SQL.
+    """
+    if granularity is Granularity.week:
+        return f'Week {day.isocalendar()[1]}'
+    if granularity is Granularity.month:
+        return day.strftime('%B')
+    return f'Q{(day.month - 1) // 3 + 1}'
+
+
+def top_ranked(keys: numpy.ndarray, totals: numpy.ndarray, name_codes: numpy.ndarray, limit: int = 10) -> numpy.ndarray:
+    """
+    Return the positions of the `limit` largest totals of every key, ordered by
+    key, then by total descending and product name.
+    """
+    order = numpy.lexsort((name_codes, -totals, keys))
+    keys = keys[order]
+    first = numpy.searchsorted(keys, keys, side='left')
+    rank = numpy.arange(len(keys)) - first
+    return order[rank < limit]
+
+
+class ColumnarStore:
+    """
+    The sales, customer, product and calendar data held in NumPy arrays,
+    answering the endpoint queries with vectorized group-bys instead of SQL.
+
+    The receipts are sorted by date, with the position of every year's first
+    receipt precomputed (year_index), so date-bounded queries work on a slice.
+    The last order of every customer is precomputed with one lexsort
+    (per-customer index).
+
+    Results are identical to the PostgreSQL path: ties between products are
+    ordered by name in code point order, which the SQL queries ask for with
+    COLLATE "C" whatever the database collation.
+    """
+    def __init__(self, customers: dict, products: dict, dates: dict, sales: dict):
+        order = numpy.argsort(customers['customer_id'], kind='stable')
+        self.customer_id = customers['customer_id'][order].astype(numpy.int64)
+        self.customer_first_name = customers['customer_first_name'][order]
+        self.customer_email = customers['customer_email'][order]
+        self.birth_month = customers['birth_month'][order]
+        self.birth_day = customers['birth_day'][order]
+
+        # Products are grouped by name, like the SQL query: names are coded in sorted order.
+        order = numpy.argsort(products['product_id'], kind='stable')
+        self.product_id = products['product_id'][order].astype(numpy.int64)
+        self.product_names, self.product_name_code = numpy.unique(products['product'][order].astype(str),
+                                                                  return_inverse=True)
+        self.product_category = products['product_category'][order].astype(str)
+
+        self.calendar_day = day_numbers(dates['transaction_date'])
+        self.calendar_labels = {Granularity.week: dates['week_desc'], Granularity.month: dates['month_name'],
+                                Granularity.quarter: dates['quarter_name']}
+
+        order = numpy.argsort(day_numbers(sales['transaction_date']), kind='stable')
+        self.sale_day = day_numbers(sales['transaction_date'])[order]
+        self.sale_outlet = sales['sales_outlet_id'][order].astype(numpy.int64)
+        self.sale_customer = sales['customer_id'][order].astype(numpy.int64)
+        self.sale_quantity = sales['quantity'][order].astype(numpy.int64)
+        # The position of every receipt's product in the product arrays, -1 for unknown products.
+        self.sale_product = lookup(self.product_id, sales['product_id'][order])
+
+        years, starts, counts = numpy.unique(self.sale_day.astype('datetime64[D]').astype('datetime64[Y]'),
+                                             return_index=True, return_counts=True)
+        self.year_index = {year: (start, start + count) for year, start, count
+                           in zip((years.astype(numpy.int64) + 1970).tolist(), starts.tolist(), counts.tolist())}
+
+        last_order_customer, last_order_day = self.last_orders(sales)
+        # Like the SQL join, only customers in the customer table have a last order.
+        position = lookup(self.customer_id, last_order_customer)
+        known = numpy.flatnonzero(position >= 0)
+        self.last_order_customer = last_order_customer[known]
+        self.last_order_day = last_order_day[known]
+        self.last_order_email = self.customer_email[position[known]]
+
+    @staticmethod
+    def last_orders(sales: dict) -> tuple:
+        """
+        Find the day of every customer's last order with one lexsort.
+
+        Returns:
+            tuple: The customer ids, in increasing order, and the day of their last order.
+        """
+        customers = sales['customer_id'].astype(numpy.int64)
+        moments = sales['transaction_datetime'].astype('datetime64[us]')
+        valid = ~numpy.isnat(moments)
+        customers, moments, transactions = customers[valid], moments[valid], sales['transaction_id'][valid]
+        order = numpy.lexsort((transactions, moments, customers))
+        customers = customers[order]
+        last = numpy.flatnonzero(numpy.append(customers[1:] != customers[:-1], True)) if len(customers) else order
+        return customers[last], day_numbers(moments[order][last])
+
+    @classmethod
+    def from_files(cls, files: dict, progress: dict = None) -> 'ColumnarStore':
+        """
+        Build the store from the dataset CSV files.
+
+        Args:
+            files (dict): The CSV file path by table object, for Customer, Product, Dates and Sales;
+                the files of other tables are skipped.
+            progress (dict): TableProgress by table name, updated as the files are read.
+
+        Returns:
+            ColumnarStore: The store.
+        """
+        started = time.perf_counter()
+        columns = {}
+        for table, csv_file in files.items():
+            table_progress = (progress or {}).get(table.Meta.tablename)
+            if table not in COLUMNS:
+                # Only used by the outlet reports, which the store does not answer.
+                if table_progress is not None:
+                    table_progress.finish('skipped')
+                continue
+            if table_progress is not None:
+                table_progress.start()
+            columns[table] = read_columns(table, csv_file, table_progress.update if table_progress else None)
+            if table_progress is not None:
+                table_progress.finish('loaded')
+        store = cls(columns[Customer], columns[Product], columns[Dates], columns[Sales])
+        logger.info('Loaded %d receipts into the columnar store in %.2fs',
+                    len(store.sale_day), time.perf_counter() - started)
+        return store
+
+    def day_slice(self, first: date, stop: date) -> slice:
+        """
+        Return the slice of the receipts dated from `first` up to, not including,
+        `stop`, which is at most the next January 1st.
+        """
+        start, end = self.year_index.get(first.year, (0, 0))
+        days = self.sale_day[start:end]
+        first_day, stop_day = day_numbers(numpy.array([first, stop], dtype='datetime64[D]'))
+        return slice(start + int(numpy.searchsorted(days, first_day)), start + int(numpy.searchsorted(days, stop_day)))
+
+    def get_birthday_customer(self, today: date) -> list:
+        """
+        The columnar counterpart of common.get_birthday_customer.
+        """
+        receipts = self.day_slice(today, today + datetime.timedelta(days=1))
+        visitors = numpy.isin(self.customer_id, self.sale_customer[receipts])
+        selected = numpy.flatnonzero(visitors & (self.birth_month == today.month) & (self.birth_day == today.day))
+        return [{'customer_id': customer_id, 'customer_first_name': first_name}
+                for customer_id, first_name in zip(self.customer_id[selected].tolist(),
+                                                   self.customer_first_name[selected].tolist())]
+
+    def period_codes(self, granularity: Granularity, days: numpy.ndarray) -> tuple:
+        """
+        Label days with their week, month or quarter, from the dates calendar when it covers them.
+
+        Returns:
+            tuple: The sorted period labels and the position of every day's label.
+        """
+        unique_days, inverse = numpy.unique(days, return_inverse=True)
+        position = numpy.searchsorted(self.calendar_day, unique_days)
+        labels = []
+        for day, index in zip(unique_days.tolist(), position.tolist()):
+            if index < len(self.calendar_day) and self.calendar_day[index] == day:
+                labels.append(str(self.calendar_labels[granularity][index]))
+            else:
+                labels.append(fallback_label(granularity, date(1970, 1, 1) + datetime.timedelta(days=day)))
+        labels, label_code = numpy.unique(numpy.array(labels, dtype=str), return_inverse=True)
+        return labels, label_code[inverse]
+
+    def top_selling_products(self, year: int, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                             outlet_id: Optional[int] = None, product_category: Optional[str] = None,
+                             granularity: Optional[Granularity] = None) -> list:
+        """
+        The columnar counterpart of common.top_selling_products.
+        """
+        if not MIN_YEAR <= year <= MAX_YEAR:
+            return []
+        first, stop = date(year, 1, 1), date(year + 1, 1, 1)
+        if start_date is not None:
+            first = max(first, start_date)
+        if end_date is not None:
+            stop = min(stop, end_date + datetime.timedelta(days=1))
+        if first >= stop:
+            return []
+        receipts = self.day_slice(first, stop)
+        product = self.sale_product[receipts]
+        selected = product >= 0
+        if outlet_id is not None:
+            selected &= self.sale_outlet[receipts] == outlet_id
+        if product_category is not None:
+            selected &= self.product_category[numpy.maximum(product, 0)] == product_category
+        name_code = self.product_name_code[product[selected]]
+        quantity = self.sale_quantity[receipts][selected]
+        names = len(self.product_names)
+
+        if granularity is None:
+            counts = numpy.bincount(name_code, minlength=names)
+            totals = numpy.bincount(name_code, weights=quantity, minlength=names).astype(numpy.int64)
+            sold = numpy.flatnonzero(counts)
+            top = sold[top_ranked(numpy.zeros(len(sold), dtype=numpy.int64), totals[sold], sold)]
+            return [{'product_name': name, 'total_sales': total}
+                    for name, total in zip(self.product_names[top].tolist(), totals[top].tolist())]
+
+        # Sum the receipts per day and product first: they are sorted by day, so
+        # the days are numbered without sorting, and the rest works on the daily sums.
+        days = self.sale_day[receipts][selected]
+        day_index = numpy.concatenate(([0], numpy.cumsum(numpy.diff(days) != 0))) if len(days) else days
+        unique_days = days[numpy.flatnonzero(numpy.diff(day_index, prepend=-1))]
+        daily = day_index * names + name_code
+        sold = numpy.flatnonzero(numpy.bincount(daily, minlength=len(unique_days) * names))
+        daily_totals = numpy.bincount(daily, weights=quantity, minlength=len(unique_days) * names)[sold]
+
+        labels, period_code = self.period_codes(Granularity(granularity), unique_days)
+        keys = period_code[sold // names] * names + sold % names
+        # The daily sums are in day order, so the first one of a key is its earliest.
+        groups, first_day, group_of = numpy.unique(keys, return_index=True, return_inverse=True)
+        totals = numpy.bincount(group_of, weights=daily_totals).astype(numpy.int64)
+        group_period, group_name = groups // names, groups % names
+        top = top_ranked(group_period, totals, group_name)
+        # Periods are ordered by the earliest sale of their top products, then by label.
+        period_start = numpy.full(len(labels), numpy.iinfo(numpy.int64).max)
+        numpy.minimum.at(period_start, group_period[top], unique_days[sold // names][first_day][top])
+        top = top[numpy.lexsort((numpy.arange(len(top)), group_period[top], period_start[group_period[top]]))]
+        return [{'period': period, 'product_name': name, 'total_sales': total}
+                for period, name, total in zip(labels[group_period[top]].tolist(),
+                                               self.product_names[group_name[top]].tolist(),
+                                               totals[top].tolist())]
+
+    def last_order_slice(self, after_customer_id: Optional[int] = None, limit: Optional[int] = None) -> slice:
+        """
+        Return the slice of the last orders on the page after `after_customer_id`, of at most `limit` customers.
+        """
+        start = 0
+        if after_customer_id is not None:
+            start = int(numpy.searchsorted(self.last_order_customer, after_customer_id, side='right'))
+        stop = len(self.last_order_customer)
+        return slice(start, stop if limit is None else min(start + limit, stop))
+
+    def last_order_per_customer(self, after_customer_id: Optional[int] = None, limit: Optional[int] = None) -> list:
+        """
+        The columnar counterpart of common.last_order_per_customer.
+        """
+        page = self.last_order_slice(after_customer_id, limit)
+        return [{'customer_id': customer_id, 'customer_email': email, 'last_order_date': last_order}
+                for customer_id, email, last_order in zip(self.last_order_customer[page].tolist(),
+                                                          self.last_order_email[page].tolist(),
+                                                          self.last_order_day[page].astype('datetime64[D]').tolist())]
+
+    def stream_last_order_per_customer(self, after_customer_id: Optional[int] = None, limit: Optional[int] = None,
+                                       chunk_size: int = STREAM_PREFETCH) -> Iterator[bytes]:
+        """
+        The columnar counterpart of common.stream_last_order_per_customer:
+        NDJSON lines of up to `chunk_size` customers, encoded a chunk at a time.
+        """
+        page = self.last_order_slice(after_customer_id, limit)
+        for start in range(page.start, page.stop, chunk_size):
+            chunk = slice(start, min(start + chunk_size, page.stop))
+            yield b''.join(map(last_order_line, self.last_order_customer[chunk].tolist(),
+                               self.last_order_email[chunk].tolist(),
+                               self.last_order_day[chunk].astype('datetime64[D]').tolist()))
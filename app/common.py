@@ -1,10 +1,53 @@
+import asyncio
+import enum
+import itertools
+import json
+import logging
+import re
+import time
+import zoneinfo
+from typing import AsyncIterator, Callable, Iterator, Optional
+
 import pandas
 from ormar import Model
 from sqlalchemy.orm import sessionmaker
 import datetime
 from datetime import date
 
+from .config import settings
+from .db import spawn_task
+from . import cache, metrics
+from .derived import copy_batch, has_derived, notify_loaded
+from .partitions import batch_months, ensure_partitions, is_partitioned, split_by_month
+from .snapshot import snapshot_for
+
+logger = logging.getLogger(__name__)
+
 data_format = ('customer_since', 'birthdate', 'transaction_date')
+DATE_FORMAT = '%Y-%m-%d'
+# The format of the date columns of a table's CSV file, DATE_FORMAT by default.
+date_formats = {'dates': '%m/%d/%Y', 'pastry_inventory': '%m/%d/%Y', 'staff': '%m/%d/%Y', 'sales_targets': '%b-%y'}
+# Normalized CSV headers that do not name their field, by table.
+header_aliases = {'sales_outlet': {'neighorhood': 'neighborhood'}}
+csv_dtype = {int: 'int64', float: 'float64'}
+nullable_csv_dtype = {int: 'Int64', float: 'float64'}
+
+
+def parse_datetime(value: str) -> datetime.datetime:
+    """
+    Parse a date or datetime string, using the fast ISO-8601 parser when possible.
+
+    Args:
+        value (str): The value to parse.
+
+    Returns:
+        datetime.datetime: The parsed value.
+    """
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return pandas.to_datetime(value).to_pydatetime()
+
 
 def prepare_row(element: dict, fields: list) -> dict:
     """
@@ -21,63 +64,467 @@ def prepare_row(element: dict, fields: list) -> dict:
     for el in element.keys():
         key = el.replace('-', '_')
         if key in fields and  key in data_format:
-            date = pandas.to_datetime(element[el])
+            date = parse_datetime(element[el])
             row[key] = date
             if key == 'birthdate':
                 row['birthday'] = f'{ date.month }-{ date.day }'
+                row['birth_month'] = date.month
+                row['birth_day'] = date.day
         elif key in fields:
             row[key] = element[el]
 
     if 'transaction_date' in row  and 'transaction_time' in row:
-        row['transaction_datetime'] = pandas.to_datetime(f'{element["transaction_date"]} {element["transaction_time"]}')
+        row['transaction_datetime'] = parse_datetime(f'{element["transaction_date"]} {element["transaction_time"]}')
     return row
 
 
-async def get_birthday_customer(table: object) -> list:
+def local_today() -> date:
+    """
+    Return the current date in the shop's time zone (settings.timezone).
+
+    Returns:
+        date: Today's date.
+    """
+    return datetime.datetime.now(zoneinfo.ZoneInfo(settings.timezone)).date()
+
+
+# Customers celebrating their birthday in the shop, per day, with the data
+# generation (see app.cache) they were read at.
+birthday_cache = dict()
+
+
+async def get_birthday_customer(database: object, today: Optional[date] = None) -> list:
     """
-    Retrieve customers with birthdays matching the current date.
+    Retrieve the customers who visit the shop today and have their birthday.
+
+    The result is cached until the end of the day, or until new data is loaded.
 
     Args:
-        table (object): The customer table object.
+        database (object): The database connection pool.
+        today (date): The day to look at; defaults to local_today().
 
     Returns:
         list: A list of dictionaries containing customer_id and customer_first_name.
     """
-    today = datetime.date.today()
-    return await table.objects.filter(birthday=f'{today.month}-{today.day}').values(['customer_id', 'customer_first_name']) 
+    today = today or local_today()
+    generation = cache.data_generation
+    if today in birthday_cache and birthday_cache[today][0] == generation:
+        return birthday_cache[today][1]
+
+    column_names = ("customer_id", "customer_first_name")
+    sql_query  = '''SELECT c.customer_id, c.customer_first_name
+                    FROM customers c
+                    WHERE c.birth_month = :month AND c.birth_day = :day
+                    AND EXISTS (
+                        SELECT 1
+                        FROM sales_reciepts s
+                        WHERE s.transaction_date = :today AND s.customer_id = c.customer_id
+                    )
+                    ORDER BY c.customer_id;
+                        '''
+    with metrics.query_duration.time('get_birthday_customer'):
+        selected = await database.fetch_all(query=sql_query, values={'month': today.month, 'day': today.day, 'today': today})
+    result = [{column_names[0]: row[0], column_names[1]: row[1]} for row in selected]
+    for day in [day for day in birthday_cache if day < today]:
+        del birthday_cache[day]
+    birthday_cache[today] = (generation, result)
+    return result
 
 
-async def top_selling_products(year: int, engine: object) -> list:
+class Granularity(str, enum.Enum):
+    """
+    The calendar periods top_selling_products can group the sales by.
+    """
+    week = 'week'
+    month = 'month'
+    quarter = 'quarter'
+
+
+class TargetCategory(str, enum.Enum):
+    """
+    The categories of the monthly sales targets, see app.aggregates.
+    """
+    beans = 'beans'
+    beverage = 'beverage'
+    food = 'food'
+    merchandise = 'merchandise'
+    total = 'total'
+
+
+class CustomerSegment(str, enum.Enum):
+    """
+    The segments of the customers by their RFM scores, see app.rfm.
+    """
+    champions = 'champions'
+    loyal = 'loyal'
+    new = 'new'
+    promising = 'promising'
+    need_attention = 'need_attention'
+    at_risk = 'at_risk'
+    hibernating = 'hibernating'
+    lost = 'lost'
+
+
+# The years the yearly queries accept: a year's sales run up to January 1st
+# of the next one, which must be a valid date.
+MIN_YEAR, MAX_YEAR = 1, datetime.MAXYEAR - 1
+
+
+# Period labels from the dates calendar dimension, computed from the date
+# itself for days the calendar does not cover.
+period_labels = {
+    Granularity.week: "COALESCE(d.week_desc, 'Week ' || EXTRACT(WEEK FROM r.sales_date))",
+    Granularity.month: "COALESCE(d.month_name, TO_CHAR(r.sales_date, 'FMMonth'))",
+    Granularity.quarter: "COALESCE(d.quarter_name, 'Q' || EXTRACT(QUARTER FROM r.sales_date))",
+}
+
+
+async def top_selling_products(year: int, database: object, start_date: Optional[date] = None,
+                               end_date: Optional[date] = None, outlet_id: Optional[int] = None,
+                               product_category: Optional[str] = None,
+                               granularity: Optional[Granularity] = None) -> list:
     """
     Retrieve the top-selling products for a specific year.
 
+    The sales are read from the product_sales_daily rollup, so the cost does
+    not depend on the number of receipts.
+
     Args:
         year (int): The year to filter the sales.
-        engine (object): The database engine object.
+        database (object): The database connection pool.
+        start_date (date): Only count sales on or after this date.
+        end_date (date): Only count sales on or before this date.
+        outlet_id (int): Only count sales of this sales outlet.
+        product_category (str): Only count products of this category.
+        granularity (Granularity): Return the top 10 products of every week, month or quarter.
 
     Returns:
-        list: A list of dictionaries containing product_name and total_sales.
+        list: A list of dictionaries containing product_name and total_sales,
+              and the period when a granularity is given; empty for a year
+              outside MIN_YEAR..MAX_YEAR.
     """
-    column_names = ("product_name", "total_sales")
-    sql_query  = f'''SELECT p.product, SUM(sr.quantity) AS total_quantity
-                    FROM sales_reciepts sr
-                    JOIN product p ON sr.product_id = p.product_id
-                    WHERE EXTRACT(YEAR FROM sr.transaction_date) = {year}
+    if not MIN_YEAR <= year <= MAX_YEAR:
+        return []
+    values = {'start_date': date(year, 1, 1), 'end_date': date(year + 1, 1, 1)}
+    if start_date is not None:
+        values['start_date'] = max(values['start_date'], start_date)
+    if end_date is not None:
+        values['end_date'] = min(values['end_date'], end_date + datetime.timedelta(days=1))
+    filters = ['r.sales_date >= :start_date', 'r.sales_date < :end_date']
+    if outlet_id is not None:
+        filters.append('r.sales_outlet_id = :outlet_id')
+        values['outlet_id'] = outlet_id
+    if product_category is not None:
+        filters.append('p.product_category = :product_category')
+        values['product_category'] = product_category
+    where = ' AND '.join(filters)
+
+    if granularity is None:
+        column_names = ("product_name", "total_sales")
+        sql_query  = f'''SELECT p.product, SUM(r.quantity) AS total_quantity
+                    FROM product_sales_daily r
+                    JOIN product p ON r.product_id = p.product_id
+                    WHERE {where}
                     GROUP BY  p.product
-                    ORDER BY total_quantity DESC
+                    ORDER BY total_quantity DESC, p.product COLLATE "C"
                     LIMIT 10;
                         '''
-    selected = engine.execute(sql_query)
-    result = [{column_names[0]: row[0], column_names[1]: row[1]} for row in selected]
-    selected.close()
-    return result
+    else:
+        column_names = ("period", "product_name", "total_sales")
+        period = period_labels[Granularity(granularity)]
+        sql_query  = f'''SELECT period, product, total_quantity
+                    FROM (
+                        SELECT {period} AS period, MIN(r.sales_date) AS period_start,
+                               p.product, SUM(r.quantity) AS total_quantity,
+                               ROW_NUMBER() OVER (PARTITION BY {period}
+                                                  ORDER BY SUM(r.quantity) DESC, p.product COLLATE "C") AS rank
+                        FROM product_sales_daily r
+                        JOIN product p ON r.product_id = p.product_id
+                        LEFT JOIN dates d ON d.transaction_date = r.sales_date
+                        WHERE {where}
+                        GROUP BY 1, p.product
+                    ) t
+                    WHERE rank <= 10
+                    ORDER BY MIN(period_start) OVER (PARTITION BY period), period, rank;
+                        '''
+    with metrics.query_duration.time('top_selling_products'):
+        selected = await database.fetch_all(query=sql_query, values=values)
+    return [{name: row[index] for index, name in enumerate(column_names)} for row in selected]
+
+
+async def outlet_sales_vs_target(year: int, database: object, month: Optional[int] = None,
+                                 outlet_id: Optional[int] = None, category: Optional[TargetCategory] = None) -> list:
+    """
+    Retrieve the units sold by every sales outlet per month and target category, against the goal.
+
+    The rows are read from the outlet_sales_monthly aggregate (see
+    app.aggregates), so the cost does not depend on the number of receipts.
+
+    Args:
+        year (int): The year of the months.
+        database (object): The database connection pool.
+        month (int): Only return this month of the year.
+        outlet_id (int): Only return this sales outlet.
+        category (TargetCategory): Only return this category.
+
+    Returns:
+        list: A list of dictionaries containing sales_outlet_id, month, month_name, category,
+              quantity, goal and percent_of_goal (None without a goal); empty
+              for a year outside MIN_YEAR..MAX_YEAR.
+    """
+    if not MIN_YEAR <= year <= MAX_YEAR:
+        return []
+    values = {'start_month': date(year, 1, 1), 'stop_month': date(year + 1, 1, 1)}
+    if month is not None:
+        values = {'start_month': date(year, month, 1), 'stop_month': date(year + month // 12, month % 12 + 1, 1)}
+    filters = ['m.month >= :start_month', 'm.month < :stop_month']
+    if outlet_id is not None:
+        filters.append('m.sales_outlet_id = :outlet_id')
+        values['outlet_id'] = outlet_id
+    if category is not None:
+        filters.append('m.category = :category')
+        values['category'] = TargetCategory(category).value
+    where = ' AND '.join(filters)
+
+    column_names = ('sales_outlet_id', 'month', 'month_name', 'category', 'quantity', 'goal', 'percent_of_goal')
+    sql_query  = f'''SELECT m.sales_outlet_id, m.month, m.month_name, m.category, m.quantity, m.goal,
+                           ROUND(100.0 * m.quantity / NULLIF(m.goal, 0), 1)
+                    FROM outlet_sales_monthly m
+                    WHERE {where}
+                    ORDER BY m.sales_outlet_id, m.month, m.category;
+                        '''
+    with metrics.query_duration.time('outlet_sales_vs_target'):
+        selected = await database.fetch_all(query=sql_query, values=values)
+    rows = [{name: row[index] for index, name in enumerate(column_names)} for row in selected]
+    for row in rows:
+        if row['percent_of_goal'] is not None:
+            row['percent_of_goal'] = float(row['percent_of_goal'])
+    return rows
+
+
+async def pastry_waste(database: object, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                       outlet_id: Optional[int] = None) -> list:
+    """
+    Retrieve the share of the pastries every sales outlet wasted per day.
+
+    The rows are read from the pastry_waste_daily aggregate (see app.aggregates).
+
+    Args:
+        database (object): The database connection pool.
+        start_date (date): Only return days on or after this date.
+        end_date (date): Only return days on or before this date.
+        outlet_id (int): Only return this sales outlet.
+
+    Returns:
+        list: A list of dictionaries containing date, sales_outlet_id, week, start_of_day,
+              quantity_sold, waste and waste_percent.
+    """
+    values = {}
+    filters = ['TRUE']
+    if start_date is not None:
+        filters.append('w.sales_date >= :start_date')
+        values['start_date'] = start_date
+    if end_date is not None:
+        filters.append('w.sales_date <= :end_date')
+        values['end_date'] = end_date
+    if outlet_id is not None:
+        filters.append('w.sales_outlet_id = :outlet_id')
+        values['outlet_id'] = outlet_id
+    where = ' AND '.join(filters)
+
+    column_names = ('date', 'sales_outlet_id', 'week', 'start_of_day', 'quantity_sold', 'waste', 'waste_percent')
+    sql_query  = f'''SELECT w.sales_date, w.sales_outlet_id, w.week_desc, w.start_of_day, w.quantity_sold,
+                           w.waste, w.waste_percent
+                    FROM pastry_waste_daily w
+                    WHERE {where}
+                    ORDER BY w.sales_date, w.sales_outlet_id;
+                        '''
+    with metrics.query_duration.time('pastry_waste'):
+        selected = await database.fetch_all(query=sql_query, values=values)
+    return [{name: row[index] for index, name in enumerate(column_names)} for row in selected]
+
+
+async def customer_rfm(database: object, segment: Optional[CustomerSegment] = None, min_monetary: Optional[float] = None,
+                       inactive_days: Optional[int] = None, after_customer_id: Optional[int] = None,
+                       limit: Optional[int] = None) -> list:
+    """
+    Retrieve the recency, frequency and monetary value of the customers, with their scores and segment.
+
+    The rows are read from the customer_rfm table computed in batches (see
+    app.rfm), through its indexes on segment, monetary and recency_days.
+
+    Args:
+        database (object): The database connection pool.
+        segment (CustomerSegment): Only return the customers of this segment.
+        min_monetary (float): Only return the customers who spent at least this amount.
+        inactive_days (int): Only return the customers who did not order for at least this many days.
+        after_customer_id (int): Only return the customers with a greater id, the last id of the previous page.
+        limit (int): Return at most this many customers.
 
-async def last_order_per_customer(engine: object) -> list:
+    Returns:
+        list: A list of dictionaries containing customer_id, customer_email, last_order_date, recency_days,
+              frequency, monetary, r_score, f_score, m_score and segment.
+    """
+    values = {}
+    filters = ['TRUE']
+    if segment is not None:
+        filters.append('r.segment = :segment')
+        values['segment'] = CustomerSegment(segment).value
+    if min_monetary is not None:
+        filters.append('r.monetary >= :min_monetary')
+        values['min_monetary'] = min_monetary
+    if inactive_days is not None:
+        filters.append('r.recency_days >= :inactive_days')
+        values['inactive_days'] = inactive_days
+    if after_customer_id is not None:
+        filters.append('r.customer_id > :after_customer_id')
+        values['after_customer_id'] = after_customer_id
+    where = ' AND '.join(filters)
+    limit_clause = ''
+    if limit is not None:
+        limit_clause = 'LIMIT :limit'
+        values['limit'] = limit
+
+    column_names = ('customer_id', 'customer_email', 'last_order_date', 'recency_days', 'frequency', 'monetary',
+                    'r_score', 'f_score', 'm_score', 'segment')
+    sql_query  = f'''SELECT r.customer_id, c.customer_email, r.last_order_date, r.recency_days, r.frequency,
+                           r.monetary, r.r_score, r.f_score, r.m_score, r.segment
+                    FROM customer_rfm r
+                    JOIN customers c ON c.customer_id = r.customer_id
+                    WHERE {where}
+                    ORDER BY r.customer_id
+                    {limit_clause};
+                        '''
+    with metrics.query_duration.time('customer_rfm'):
+        selected = await database.fetch_all(query=sql_query, values=values)
+    return [{name: row[index] for index, name in enumerate(column_names)} for row in selected]
+
+# Rows fetched per round trip when streaming the last orders.
+STREAM_PREFETCH = 1000
+
+
+def last_order_query(after_customer_id: Optional[int], limit: Optional[int], parameter: Callable) -> str:
+    """
+    Build the query of the last order per customer, a page of it when a
+    keyset (after_customer_id) or a limit is given.
+
+    The primary key on customer_last_order.customer_id serves both the
+    keyset condition and the order, so a page costs the same wherever it
+    starts.
+
+    Args:
+        after_customer_id (int): Only return the customers with a greater id.
+        limit (int): Return at most this many customers.
+        parameter (Callable): Called with the name and value of each query
+            parameter, returns its placeholder.
+
+    Returns:
+        str: The SQL query.
+    """
+    where = ''
+    if after_customer_id is not None:
+        where = f'WHERE l.customer_id > {parameter("after_customer_id", after_customer_id)}'
+    page = f'LIMIT {parameter("limit", limit)}' if limit is not None else ''
+    return f'''SELECT l.customer_id, c.customer_email, CAST(l.last_order_datetime AS DATE)
+                    FROM customer_last_order l
+                    JOIN customers c ON l.customer_id = c.customer_id
+                    {where}
+                    ORDER BY l.customer_id
+                    {page};
+                        '''
+
+
+async def last_order_per_customer(database: object, after_customer_id: Optional[int] = None,
+                                  limit: Optional[int] = None) -> list:
     """
     Retrieve the last order (based on transaction_date) for each customer.
 
+    The orders are read from the customer_last_order table maintained by the
+    ingest path.
+
+    Args:
+        database (object): The database connection pool.
+        after_customer_id (int): Only return the customers with a greater id, the last id of the previous page.
+        limit (int): Return at most this many customers.
+
+    Returns:
+        list: A list of dictionaries containing customer_id, customer_email, and last_order_date.
+    """
+    column_names = ("customer_id", "customer_email", "last_order_date")
+    values = {}
+
+    def parameter(name: str, value: int) -> str:
+        values[name] = value
+        return f':{name}'
+
+    sql_query = last_order_query(after_customer_id, limit, parameter)
+    with metrics.query_duration.time('last_order_per_customer'):
+        selected = await database.fetch_all(query=sql_query, values=values)
+    return [{column_names[0]: row[0], column_names[1]: row[1], column_names[2]: row[2]} for row in selected]
+
+
+def last_order_line(customer_id: int, customer_email: Optional[str], last_order_date: date) -> bytes:
+    """
+    Encode one last order as an NDJSON line, the same object the JSON endpoint returns per customer.
+
+    Args:
+        customer_id (int): The customer id.
+        customer_email (str): The customer's email.
+        last_order_date (date): The date of the customer's last order.
+
+    Returns:
+        bytes: The JSON object followed by a newline.
+    """
+    return (f'{{"customer_id":{customer_id},"customer_email":{json.dumps(customer_email, ensure_ascii=False)},'
+            f'"last_order_date":"{last_order_date.isoformat()}"}}\n').encode()
+
+
+async def stream_last_order_per_customer(database: object, after_customer_id: Optional[int] = None,
+                                         limit: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Stream the last order per customer as NDJSON, reading the rows from a server-side cursor.
+
+    At most STREAM_PREFETCH rows are held at a time, so memory does not grow
+    with the number of customers. The connection is held until the stream is
+    exhausted or closed.
+
+    Args:
+        database (object): The database connection pool.
+        after_customer_id (int): Only return the customers with a greater id.
+        limit (int): Return at most this many customers.
+
+    Yields:
+        bytes: The NDJSON lines of up to STREAM_PREFETCH customers.
+    """
+    args = []
+
+    def parameter(name: str, value: int) -> str:
+        args.append(value)
+        return f'${len(args)}'
+
+    sql_query = last_order_query(after_customer_id, limit, parameter)
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        async with raw_connection.transaction(readonly=True):
+            cursor = raw_connection.cursor(sql_query, *args, prefetch=STREAM_PREFETCH)
+            lines = []
+            async for row in cursor:
+                lines.append(last_order_line(row[0], row[1], row[2]))
+                if len(lines) == STREAM_PREFETCH:
+                    yield b''.join(lines)
+                    lines = []
+            if lines:
+                yield b''.join(lines)
+
+
+async def last_order_per_customer_from_receipts(database: object) -> list:
+    """
+    Retrieve the last order for each customer by aggregating the whole sales_reciepts table.
+
+    This is the reference query last_order_per_customer is checked against.
+
     Args:
-        engine (object): The database engine object.
+        database (object): The database connection pool.
 
     Returns:
         list: A list of dictionaries containing customer_id, customer_email, and last_order_date.
@@ -93,27 +540,408 @@ async def last_order_per_customer(engine: object) -> list:
                     JOIN customers c ON s.customer_id = c.customer_id
                     ORDER BY s.customer_id;
                         '''
-    selected = engine.execute(sql_query)
-    result = [{column_names[0]: row[0], column_names[1]: row[1], column_names[2]: row[2]} for row in selected]    
-    selected.close()
-    return result
+    with metrics.query_duration.time('last_order_per_customer_from_receipts'):
+        selected = await database.fetch_all(query=sql_query)
+    return [{column_names[0]: row[0], column_names[1]: row[1], column_names[2]: row[2]} for row in selected]
+
+
+async def check_last_order_consistency(database: object) -> list:
+    """
+    Compare last_order_per_customer with the reference query over sales_reciepts.
+
+    Args:
+        database (object): The database connection pool.
+
+    Returns:
+        list: The rows that are only in one of the two results, empty when they match.
+    """
+    maintained = await last_order_per_customer(database)
+    reference = await last_order_per_customer_from_receipts(database)
+    matching = {tuple(row.values()) for row in maintained} & {tuple(row.values()) for row in reference}
+    return [row for row in maintained + reference if tuple(row.values()) not in matching]
+
+
+def column_key(name: str, tablename: Optional[str] = None) -> str:
+    """
+    Return the table field name for a CSV header.
+
+    The header is lower-cased, `%` spelled out and every run of other
+    characters than letters and digits replaced by one underscore, so
+    "customer_first-name" becomes customer_first_name, "merchandise _goal"
+    merchandise_goal and "% waste" percent_waste. The table's header_aliases
+    then fix misspelled headers.
+
+    Args:
+        name (str): The CSV header.
+        tablename (str): The table the file is loaded into.
+
+    Returns:
+        str: The field name.
+    """
+    key = re.sub(r'[^0-9a-z]+', '_', name.strip().lower().replace('%', ' percent ')).strip('_')
+    return header_aliases.get(tablename, {}).get(key, key)
+
+
+def csv_dtypes(table: object, header: list) -> dict:
+    """
+    Build explicit read_csv dtypes for the CSV columns that map to a table field.
+
+    Date and time columns are read as strings and parsed afterwards with an
+    explicit format by prepare_frame.
+
+    Args:
+        table (object): The table object.
+        header (list): The column names of the CSV file.
+
+    Returns:
+        dict: A mapping of CSV column name to dtype.
+    """
+    columns = table.Meta.table.columns
+    dtypes = dict()
+    for name in header:
+        key = column_key(name, table.Meta.tablename)
+        if key not in columns:
+            continue
+        column = columns[key]
+        dtype = nullable_csv_dtype if column.nullable else csv_dtype
+        dtypes[name] = dtype.get(column.type.python_type, str)
+    return dtypes
+
+
+def read_csv(table: object, csv_file, **kwargs) -> pandas.DataFrame:
+    """
+    Read a CSV file using explicit dtypes for the columns of a table.
+
+    Args:
+        table (object): The table object.
+        csv_file (str or file): The path to the CSV file, or the file opened in binary mode.
+        **kwargs: Extra arguments passed to pandas.read_csv, e.g. `chunksize` to
+            get an iterator of DataFrames.
+
+    Returns:
+        pandas.DataFrame: The raw data.
+    """
+    header = pandas.read_csv(csv_file, nrows=0).columns
+    if hasattr(csv_file, 'seek'):
+        csv_file.seek(0)
+    return pandas.read_csv(csv_file, dtype=csv_dtypes(table, header), **kwargs)
+
+
+def prepare_frame(data_frame: pandas.DataFrame, table: object) -> pandas.DataFrame:
+    """
+    Prepare a whole DataFrame column-wise, the vectorized counterpart of prepare_row.
+
+    Headers are renamed with column_key, columns that are not table fields are
+    dropped (e.g. the unnamed trailing columns of staff.csv), the columns of
+    date fields are parsed with the table's format from date_formats
+    (DATE_FORMAT by default) and `birthday`, `birth_month`, `birth_day` and
+    `transaction_datetime` are derived in one pass.
+
+    Args:
+        data_frame (pandas.DataFrame): The raw data.
+        table (object): The table object the data is prepared for.
+
+    Returns:
+        pandas.DataFrame: The prepared data, one typed column per table field.
+    """
+    fields = table.__fields__.keys()
+    columns = table.Meta.table.columns
+    frame = data_frame.rename(columns=lambda name: column_key(name, table.Meta.tablename))
+    frame = frame[[name for name in frame.columns if name in fields]].copy()
+
+    date_format = date_formats.get(table.Meta.tablename, DATE_FORMAT)
+    for key in frame.columns:
+        if columns[key].type.python_type in (datetime.date, datetime.datetime):
+            frame[key] = pandas.to_datetime(frame[key], format=date_format)
+    if 'birthdate' in frame and 'birthday' in fields:
+        birthdate = frame['birthdate'].dt
+        frame['birthday'] = birthdate.month.astype(str) + '-' + birthdate.day.astype(str)
+        frame['birth_month'] = birthdate.month
+        frame['birth_day'] = birthdate.day
+    if 'transaction_time' in frame:
+        time_of_day = pandas.to_timedelta(frame['transaction_time'])
+        if 'transaction_date' in frame and 'transaction_datetime' in fields:
+            frame['transaction_datetime'] = frame['transaction_date'] + time_of_day
+        frame['transaction_time'] = (pandas.Timestamp(0) + time_of_day).dt.time
+    return frame
+
+
+def frame_records(frame: pandas.DataFrame, table: object) -> tuple:
+    """
+    Convert a prepared DataFrame into records for COPY.
+
+    Each column is converted once to the Python type asyncpg expects for the
+    column's PostgreSQL type, with missing values as None.
+
+    Args:
+        frame (pandas.DataFrame): The prepared data.
+        table (object): The table object.
+
+    Returns:
+        tuple: The column names and an iterator of record tuples.
+    """
+    columns = table.Meta.table.columns
+    values = []
+    for name in frame.columns:
+        series = frame[name]
+        python_type = columns[name].type.python_type
+        if python_type is datetime.date:
+            converted = series.dt.date
+        elif python_type is datetime.datetime:
+            converted = pandas.Series(series.dt.to_pydatetime(), index=series.index, dtype=object)
+        else:
+            converted = series
+        values.append(converted.astype(object).where(series.notna(), None).tolist())
+    return list(frame.columns), zip(*values)
+
+
+async def write_batch(raw_connection: object, table: object, columns: list, batch: list) -> None:
+    """
+    Write a batch of records into a table with PostgreSQL COPY and run the load listeners.
+
+    The partitions the batch needs are created first (see app.partitions),
+    and tables with derived tables (see app.derived) are refreshed in the
+    same transaction as the batch.
+
+    Args:
+        raw_connection (object): The asyncpg connection.
+        table (object): The table object to load the data into.
+        columns (list): The column names, in the order of the record values.
+        batch (list): The records (tuples) to load.
+
+    Returns:
+        None
+    """
+    if is_partitioned(table):
+        await ensure_partitions(raw_connection, table, batch_months(table, columns, batch))
+    if has_derived(table):
+        await copy_batch(raw_connection, table, columns, batch)
+    else:
+        await raw_connection.copy_records_to_table(table.Meta.tablename, records=batch, columns=columns)
+    notify_loaded(table, columns, batch)
+
+
+async def copy_records(table: object, columns: list, records, batch_size: int = None) -> int:
+    """
+    Stream records into a table in batches using PostgreSQL COPY.
 
-async def load_table(table: object, csv_file: str) -> None:
+    Tables with derived tables (see app.derived) are refreshed batch by batch,
+    in the same transaction as the batch.
+
+    Args:
+        table (object): The table object to load the data into.
+        columns (list): The column names, in the order of the record values.
+        records (iterable): The records (tuples) to load.
+        batch_size (int): Number of records sent per COPY; defaults to settings.ingest_batch_size.
+
+    Returns:
+        int: The number of records loaded.
+    """
+    batch_size = batch_size or settings.ingest_batch_size
+    records = iter(records)
+    loaded = 0
+    async with table.Meta.database.connection() as connection:
+        raw_connection = connection.raw_connection
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            await write_batch(raw_connection, table, columns, batch)
+            loaded += len(batch)
+    return loaded
+
+
+class PartitionWriters:
+    """
+    Writes the records of a partitioned table on several connections at once,
+    the records of one month always on the same connection.
+
+    Every batch is committed on its own, so the writes cannot take part in an
+    outer transaction. Different months do not compete for the rows of the
+    partitions or of the daily derived tables, so the connections do not wait
+    on each other.
+
+    Files are mostly in date order, so the batches queued at once are bounded
+    in total rather than per connection: the reader can run a few months
+    ahead, keeping every connection busy.
+
+    Attributes:
+        table (object): The partitioned table object.
+        error (BaseException): The first error a writer ran into, if any.
+        tasks (list): The writer tasks, one per connection.
+    """
+    def __init__(self, table: object, workers: int):
+        self.table = table
+        self.error = None
+        self.queues = [asyncio.Queue() for _ in range(workers)]
+        self.room = asyncio.Semaphore(workers * 4)
+        self.tasks = [spawn_task(self.write(queue)) for queue in self.queues]
+
+    async def write(self, queue: asyncio.Queue) -> None:
+        async with self.table.Meta.database.connection() as connection:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                try:
+                    # After an error, keep taking batches off the queue, so put() does not block for good.
+                    if self.error is None:
+                        await write_batch(connection.raw_connection, self.table, *item)
+                except Exception as error:
+                    self.error = error
+                finally:
+                    self.room.release()
+
+    async def put(self, columns: list, records: list) -> None:
+        """
+        Queue records for writing, split by month.
+
+        Raises:
+            Exception: The error a writer ran into.
+        """
+        for month, batch in split_by_month(self.table, columns, records):
+            if self.error is not None:
+                raise self.error
+            await self.room.acquire()
+            self.queues[(month.year * 12 + month.month) % len(self.queues)].put_nowait((columns, batch))
+
+    async def close(self) -> None:
+        """
+        Wait until the queued records are written.
+
+        Raises:
+            Exception: The error a writer ran into.
+        """
+        for queue in self.queues:
+            queue.put_nowait(None)
+        await asyncio.gather(*self.tasks)
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self) -> None:
+        """
+        Stop writing, e.g. when reading the file failed.
+        """
+        for task in self.tasks:
+            task.cancel()
+
+
+def prepared_chunks(table: object, csv_file: str, batch_size: int, skip_rows: int = 0,
+                    content_hash: Optional[str] = None) -> Iterator[tuple]:
+    """
+    Yield the prepared data of a CSV file in chunks of at most `batch_size` rows.
+
+    The frames come from the file's snapshot when there is one (see
+    app.snapshot). Otherwise the CSV is parsed with read_csv and prepared by
+    prepare_frame, and a full read also writes the snapshot for the next time.
+
+    Args:
+        table (object): The table object the data is prepared for.
+        csv_file (str): The path to the CSV file.
+        batch_size (int): The maximum number of rows per chunk.
+        skip_rows (int): Number of data rows at the start of the file to skip.
+        content_hash (str): The SHA-256 hex digest of the file, if already known.
+
+    Returns:
+        Iterator[tuple]: The prepared frames, each with the number of bytes of the file read so far.
+    """
+    snapshot = snapshot_for(table, csv_file, content_hash)
+    if snapshot is not None and snapshot.exists():
+        yield from snapshot.read(batch_size, skip_rows)
+        return
+
+    writer = snapshot.writer() if snapshot is not None and not skip_rows else None
+    try:
+        with open(csv_file, 'rb') as source:
+            with read_csv(table, source, skiprows=range(1, skip_rows + 1), chunksize=batch_size) as reader:
+                for chunk in reader:
+                    frame = prepare_frame(chunk, table)
+                    if writer is not None:
+                        writer.write(frame)
+                    yield frame, source.tell()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.commit()
+
+
+def next_records(table: object, chunks: Iterator[tuple]) -> Optional[tuple]:
+    """
+    Convert the next prepared chunk into records for COPY.
+
+    Args:
+        table (object): The table object.
+        chunks (Iterator[tuple]): The chunks returned by prepared_chunks.
+
+    Returns:
+        tuple: The column names, the list of records and the bytes of the file
+        read so far, or None after the last chunk.
+    """
+    chunk = next(chunks, None)
+    if chunk is None:
+        return None
+    frame, bytes_read = chunk
+    columns, records = frame_records(frame, table)
+    return columns, list(records), bytes_read
+
+
+async def load_table(table: object, csv_file: str, batch_size: int = None, skip_rows: int = 0,
+                     progress: Optional[Callable[[int, int], None]] = None, content_hash: Optional[str] = None,
+                     workers: int = 1) -> int:
     """
     Load data from a CSV file into a table.
 
+    The data is streamed in chunks of `batch_size` rows from prepared_chunks,
+    so memory use does not depend on the size of the file. Chunks are read and
+    prepared in a worker thread, so the event loop keeps serving requests, and
+    are sent to PostgreSQL through COPY. With several workers, the chunks of a
+    partitioned table are written to their partitions on that many
+    connections at once (see PartitionWriters).
+
     Args:
         table (object): The table object to load the data into.
         csv_file (str): The path to the CSV file.
+        batch_size (int): Number of rows per chunk and COPY; defaults to settings.ingest_batch_size.
+        skip_rows (int): Number of data rows at the start of the file to skip.
+        progress (Callable): Called with the rows loaded and the bytes read so far after every chunk.
+        content_hash (str): The SHA-256 hex digest of the file, if already known.
+        workers (int): The connections a partitioned table is written on; with
+            more than one, every batch is committed on its own.
 
     Returns:
-        None
+        int: The number of rows loaded.
     """
-    fields = table.__fields__.keys()
-    data_frame = pandas.read_csv(csv_file)
-    data_dict = data_frame.to_dict(orient='records')
-    for el in data_dict:
-        new_el = prepare_row(el, fields)
-        #await table.objects.get_or_create(**new_el)
-        await table.objects.create(**new_el)
-    
\ No newline at end of file
+    batch_size = batch_size or settings.ingest_batch_size
+    started = time.perf_counter()
+    loaded = 0
+    chunks = prepared_chunks(table, csv_file, batch_size, skip_rows=skip_rows, content_hash=content_hash)
+    writers = PartitionWriters(table, workers) if workers > 1 and is_partitioned(table) else None
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next_records, table, chunks)
+            if chunk is None:
+                break
+            columns, records, bytes_read = chunk
+            if writers is not None:
+                await writers.put(columns, records)
+                loaded += len(records)
+            else:
+                loaded += await copy_records(table, columns, records, batch_size=batch_size)
+            if progress is not None:
+                progress(loaded, bytes_read)
+        if writers is not None:
+            await writers.close()
+            writers = None
+    finally:
+        chunks.close()
+        if writers is not None:
+            writers.cancel()
+
+    elapsed = time.perf_counter() - started
+    rows_per_second = loaded / elapsed if elapsed else 0
+    logger.info('Loaded %d rows into %s in %.2fs (%.0f rows/s)',
+                loaded, table.Meta.tablename, elapsed, rows_per_second)
+    metrics.observe_load(table.Meta.tablename, loaded, elapsed)
+    return loaded
@@ -4,8 +4,27 @@ import os
 
 from pydantic import BaseSettings, Field
 
+HOME = os.path.abspath(os.path.dirname(__file__))
+
 
 class Settings(BaseSettings):
     db_url: str = Field(..., env='DATABASE_URL')
+    ingest_batch_size: int = Field(10000, env='INGEST_BATCH_SIZE')
+    ingest_workers: int = Field(1, env='INGEST_WORKERS')  # connections loading partitions at once; >1 commits every batch
+    rfm_workers: int = Field(2, env='RFM_WORKERS')  # processes computing customer_rfm shards at once
+    pool_min_size: int = Field(2, env='DB_POOL_MIN_SIZE')
+    pool_max_size: int = Field(10, env='DB_POOL_MAX_SIZE')
+    statement_timeout: int = Field(30000, env='DB_STATEMENT_TIMEOUT')  # milliseconds, 0 disables it
+    statement_cache_size: int = Field(100, env='DB_STATEMENT_CACHE_SIZE')  # 0 disables prepared statement caching
+    response_cache_size: int = Field(256, env='RESPONSE_CACHE_SIZE')
+    timezone: str = Field('UTC', env='SHOP_TIMEZONE')  # the shop's local time zone, e.g. America/New_York
+    backend: str = Field('postgres', env='BACKEND')  # postgres, or columnar to answer from in-memory arrays
+    dataset_dir: str = Field(os.path.join(HOME, '..', 'dataset'), env='DATASET_DIR')
+    snapshot_dir: str = Field(os.path.join(HOME, '..', '.snapshots'), env='SNAPSHOT_DIR')  # empty disables snapshots
+    snapshot_min_bytes: int = Field(1 << 20, env='SNAPSHOT_MIN_BYTES')  # smaller files are always parsed
+    receipt_batch_size: int = Field(1000, env='RECEIPT_BATCH_SIZE')
+    receipt_batch_delay: float = Field(0.2, env='RECEIPT_BATCH_DELAY')  # seconds a batch waits for more receipts
+    receipt_queue_size: int = Field(50000, env='RECEIPT_QUEUE_SIZE')  # rows waiting to be written, at most
+    receipt_queue_timeout: float = Field(1.0, env='RECEIPT_QUEUE_TIMEOUT')  # seconds a request waits for room
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
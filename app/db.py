@@ -1,14 +1,25 @@
 # app/db.py
 
+import asyncio
+import contextvars
+import datetime
+from typing import Coroutine
+
 import databases
 import ormar
 import sqlalchemy
 from ormar import String, Integer, Date, Time
-from sqlalchemy_utils import database_exists, create_database, drop_database
+from sqlalchemy_utils import database_exists, create_database
 
 from .config import settings
 
-database = databases.Database(settings.db_url)
+database = databases.Database(
+    settings.db_url,
+    min_size=settings.pool_min_size,
+    max_size=settings.pool_max_size,
+    statement_cache_size=settings.statement_cache_size,
+    server_settings={'statement_timeout': str(settings.statement_timeout)},
+)
 metadata = sqlalchemy.MetaData()
 
 
@@ -17,6 +28,23 @@ class BaseMeta(ormar.ModelMeta):
     database = database
 
 
+def spawn_task(coro: Coroutine) -> asyncio.Task:
+    """
+    Run a coroutine in a task that acquires its own database connections.
+
+    databases keeps the current connection in a context variable, so a task
+    copying the caller's context would share the caller's connection, and
+    its transaction. The task is started from an empty context instead.
+
+    Args:
+        coro (Coroutine): The coroutine to run.
+
+    Returns:
+        asyncio.Task: The task.
+    """
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+
 class Customer(ormar.Model):
     """
     Model representing the customers table.
@@ -30,11 +58,14 @@ class Customer(ormar.Model):
         loyalty_card_number (str): The loyalty card number of the customer.
         birthdate (datetime.date): The birthdate of the customer.
         birthday (str): The formatted birthday of the customer.
+        birth_month (int): The month of the customer's birthday.
+        birth_day (int): The day of the month of the customer's birthday.
         gender (str): The gender of the customer.
         birth_year (int): The birth year of the customer.
     """
     class Meta(BaseMeta):
         tablename = 'customers'
+        constraints = [ormar.IndexColumns('birth_month', 'birth_day')]
 
     customer_id = ormar.Integer(primary_key=True)
     home_store = ormar.Integer()
@@ -44,6 +75,8 @@ class Customer(ormar.Model):
     loyalty_card_number = ormar.String(max_length=50)
     birthdate = ormar.Date()
     birthday = ormar.String(max_length=50)
+    birth_month = ormar.SmallInteger()
+    birth_day = ormar.SmallInteger()
     gender = ormar.String(max_length=1, default='N')
     birth_year = ormar.Integer()
 
@@ -72,6 +105,14 @@ class Sales(ormar.Model):
     """
     class Meta(BaseMeta):
         tablename = 'sales_reciepts'
+        constraints = [
+            # birthday customers: who visited on a day
+            ormar.IndexColumns('transaction_date', 'customer_id'),
+            # a customer's receipts, latest first
+            ormar.IndexColumns('customer_id', 'transaction_datetime'),
+            # ingest high-water mark
+            ormar.IndexColumns('transaction_datetime'),
+        ]
 
     id = ormar.Integer(primary_key=True)
     transaction_id = ormar.Integer()
@@ -91,6 +132,36 @@ class Sales(ormar.Model):
     promo_item_yn =ormar.String(max_length=1, default='N')
 
 
+# The tables range-partitioned by month, with their partition key column.
+monthly_partitions = {}
+
+
+def partition_by_month(table: object, column: str) -> None:
+    """
+    Declare a table range-partitioned by month on a date column.
+
+    PostgreSQL requires the partition key in the primary key, so the column
+    joins it. The partitions are created as data arrives, see app.partitions.
+
+    Args:
+        table (object): The table object.
+        column (str): The name of the date column.
+    """
+    sa_table = table.Meta.table
+    for pk_column in sa_table.primary_key.columns:
+        # Still SERIAL, though no longer the only primary key column.
+        pk_column.autoincrement = True
+    key = sa_table.columns[column]
+    key.primary_key = True
+    sa_table.primary_key.columns.add(key)
+    sa_table.dialect_options['postgresql']['partition_by'] = f'RANGE ({column})'
+    monthly_partitions[table.Meta.tablename] = column
+
+
+# Queries on a day, a date range or a year only scan the partitions of their months.
+partition_by_month(Sales, 'transaction_date')
+
+
 class Product(ormar.Model):
     """
     Model representing the product table.
@@ -126,10 +197,488 @@ class Product(ormar.Model):
     new_product_yn = ormar.String(max_length=1, default='N')
 
 
+class Dates(ormar.Model):
+    """
+    Model representing the dates table, the calendar dimension.
+
+    Attributes:
+        transaction_date (datetime.date): The calendar date (primary key).
+        date_id (int): The date as a YYYYMMDD number.
+        week_id (int): The week of the year.
+        week_desc (str): The week label, e.g. "Week 14".
+        month_id (int): The month of the year.
+        month_name (str): The month name.
+        quarter_id (int): The quarter of the year.
+        quarter_name (str): The quarter label, e.g. "Q2".
+        year_id (int): The year.
+    """
+    class Meta(BaseMeta):
+        tablename = 'dates'
+
+    transaction_date = ormar.Date(primary_key=True)
+    date_id = ormar.Integer()
+    week_id = ormar.Integer()
+    week_desc = ormar.String(max_length=20)
+    month_id = ormar.Integer()
+    month_name = ormar.String(max_length=20)
+    quarter_id = ormar.Integer()
+    quarter_name = ormar.String(max_length=20)
+    year_id = ormar.Integer()
+
+
+class SalesOutlet(ormar.Model):
+    """
+    Model representing the sales_outlet table.
+
+    Attributes:
+        sales_outlet_id (int): The unique identifier for the sales outlet (primary key).
+        sales_outlet_type (str): The type of the outlet, retail or warehouse.
+        store_square_feet (int): The floor space of the outlet.
+        store_address (str): The street address of the outlet.
+        store_city (str): The city of the outlet.
+        store_state_province (str): The state or province of the outlet.
+        store_telephone (str): The telephone number of the outlet.
+        store_postal_code (str): The postal code of the outlet.
+        store_longitude (float): The longitude of the outlet.
+        store_latitude (float): The latitude of the outlet.
+        manager (int): The staff_id of the outlet's manager, if any.
+        neighborhood (str): The neighborhood of the outlet (the Neighorhood column of the CSV file).
+    """
+    class Meta(BaseMeta):
+        tablename = 'sales_outlet'
+
+    sales_outlet_id = ormar.Integer(primary_key=True)
+    sales_outlet_type = ormar.String(max_length=20)
+    store_square_feet = ormar.Integer()
+    store_address = ormar.String(max_length=100)
+    store_city = ormar.String(max_length=50)
+    store_state_province = ormar.String(max_length=20)
+    store_telephone = ormar.String(max_length=20)
+    store_postal_code = ormar.String(max_length=10)
+    store_longitude = ormar.Float()
+    store_latitude = ormar.Float()
+    manager = ormar.Integer(nullable=True)
+    neighborhood = ormar.String(max_length=50)
+
+
+class Staff(ormar.Model):
+    """
+    Model representing the staff table.
+
+    Attributes:
+        staff_id (int): The unique identifier for the staff member (primary key).
+        first_name (str): The first name of the staff member.
+        last_name (str): The last name of the staff member.
+        position (str): The position of the staff member.
+        start_date (datetime.date): The date the staff member started.
+        location (str): Where the staff member works: a sales_outlet_id, HQ or WH.
+    """
+    class Meta(BaseMeta):
+        tablename = 'staff'
+
+    staff_id = ormar.Integer(primary_key=True)
+    first_name = ormar.String(max_length=50)
+    last_name = ormar.String(max_length=50)
+    position = ormar.String(max_length=50)
+    start_date = ormar.Date()
+    location = ormar.String(max_length=10)
+
+
+class Generation(ormar.Model):
+    """
+    Model representing the generations table, the generation of every birth year.
+
+    Attributes:
+        birth_year (int): The birth year (primary key).
+        generation (str): The generation, e.g. "Baby Boomers".
+    """
+    class Meta(BaseMeta):
+        tablename = 'generations'
+
+    birth_year = ormar.Integer(primary_key=True)
+    generation = ormar.String(max_length=50)
+
+
+class SalesTarget(ormar.Model):
+    """
+    Model representing the sales_targets table, the monthly goals of every
+    sales outlet, in units sold per product category.
 
-engine = sqlalchemy.create_engine(settings.db_url)
-if database_exists(engine.url):
-    drop_database(engine.url)
-create_database(engine.url)
+    Attributes:
+        id (int): The unique identifier for the row (primary key).
+        sales_outlet_id (int): The identifier for the sales outlet.
+        year_month (datetime.date): The first day of the month.
+        beans_goal (int): The goal for whole beans and teas.
+        beverage_goal (int): The goal for beverages.
+        food_goal (int): The goal for food.
+        merchandise_goal (int): The goal for merchandise.
+        total_goal (int): The goal for the four categories together.
+    """
+    class Meta(BaseMeta):
+        tablename = 'sales_targets'
+        constraints = [ormar.UniqueColumns('sales_outlet_id', 'year_month')]
 
-metadata.create_all(engine)
+    id = ormar.Integer(primary_key=True)
+    sales_outlet_id = ormar.Integer()
+    year_month = ormar.Date()
+    beans_goal = ormar.Integer()
+    beverage_goal = ormar.Integer()
+    food_goal = ormar.Integer()
+    merchandise_goal = ormar.Integer()
+    total_goal = ormar.Integer()
+
+
+class PastryInventory(ormar.Model):
+    """
+    Model representing the pastry_inventory table, the daily pastry stock of
+    every sales outlet.
+
+    Attributes:
+        id (int): The unique identifier for the row (primary key).
+        sales_outlet_id (int): The identifier for the sales outlet.
+        transaction_date (datetime.date): The day.
+        product_id (int): The identifier for the pastry.
+        start_of_day (int): The pastries in stock when the day started.
+        quantity_sold (int): The pastries sold.
+        waste (int): The pastries left at the end of the day.
+    """
+    class Meta(BaseMeta):
+        tablename = 'pastry_inventory'
+        constraints = [ormar.UniqueColumns('sales_outlet_id', 'transaction_date', 'product_id')]
+
+    id = ormar.Integer(primary_key=True)
+    sales_outlet_id = ormar.Integer()
+    transaction_date = ormar.Date()
+    product_id = ormar.Integer()
+    start_of_day = ormar.Integer()
+    quantity_sold = ormar.Integer()
+    waste = ormar.Integer()
+
+
+class ProductSalesDaily(ormar.Model):
+    """
+    Model representing the product_sales_daily table, a rollup of sales_reciepts
+    per day, product and sales outlet maintained by the ingest path.
+
+    Attributes:
+        id (int): The unique identifier for the row (primary key).
+        sales_date (datetime.date): The date of the sales.
+        product_id (int): The identifier for the product.
+        sales_outlet_id (int): The identifier for the sales outlet.
+        quantity (int): The total quantity sold.
+        line_item_amount (float): The total amount of the line items.
+        line_items (int): The number of line items.
+    """
+    class Meta(BaseMeta):
+        tablename = 'product_sales_daily'
+        constraints = [ormar.UniqueColumns('sales_date', 'product_id', 'sales_outlet_id')]
+
+    id = ormar.Integer(primary_key=True)
+    sales_date = ormar.Date()
+    product_id = ormar.Integer()
+    sales_outlet_id = ormar.Integer()
+    quantity = ormar.Integer()
+    line_item_amount = ormar.Float()
+    line_items = ormar.Integer()
+
+
+class CustomerLastOrder(ormar.Model):
+    """
+    Model representing the customer_last_order table, the latest receipt of
+    every customer maintained by the ingest path.
+
+    Attributes:
+        customer_id (int): The identifier for the customer (primary key).
+        last_order_datetime (datetime.datetime): The date and time of the customer's last transaction.
+        last_transaction_id (int): The identifier of the customer's last transaction.
+    """
+    class Meta(BaseMeta):
+        tablename = 'customer_last_order'
+
+    customer_id = ormar.Integer(primary_key=True, autoincrement=False)
+    last_order_datetime = ormar.DateTime()
+    last_transaction_id = ormar.Integer()
+
+
+class CustomerRfmState(ormar.Model):
+    """
+    Model representing the customer_rfm_state table, which tracks the
+    customers whose receipts changed since customer_rfm was last computed
+    for them (see app.rfm).
+
+    Attributes:
+        customer_id (int): The identifier for the customer (primary key).
+        changes (int): The loaded batches that held receipts of the customer.
+        computed_changes (int): The value of changes when customer_rfm was last computed for the customer.
+    """
+    class Meta(BaseMeta):
+        tablename = 'customer_rfm_state'
+
+    customer_id = ormar.Integer(primary_key=True, autoincrement=False)
+    changes = ormar.Integer()
+    computed_changes = ormar.Integer(default=0, server_default='0', nullable=False)
+
+
+class OutletSalesMonthly(ormar.Model):
+    """
+    Model representing the outlet_sales_monthly table: the units sold by every
+    sales outlet per calendar month and target category, next to the goal,
+    materialized after every ingest (see app.aggregates).
+
+    Attributes:
+        id (int): The unique identifier for the row (primary key).
+        sales_outlet_id (int): The identifier for the sales outlet.
+        month (datetime.date): The first day of the month.
+        year_id (int): The year, from the dates calendar.
+        month_name (str): The month name, from the dates calendar.
+        category (str): The target category: beans, beverage, food, merchandise or total.
+        quantity (int): The units sold.
+        line_item_amount (float): The amount of the line items sold.
+        goal (int): The units to sell, if the outlet has a target for the month.
+    """
+    class Meta(BaseMeta):
+        tablename = 'outlet_sales_monthly'
+        constraints = [ormar.UniqueColumns('month', 'sales_outlet_id', 'category')]
+
+    id = ormar.Integer(primary_key=True)
+    sales_outlet_id = ormar.Integer()
+    month = ormar.Date()
+    year_id = ormar.Integer()
+    month_name = ormar.String(max_length=20)
+    category = ormar.String(max_length=20)
+    quantity = ormar.Integer()
+    line_item_amount = ormar.Float()
+    goal = ormar.Integer(nullable=True)
+
+
+class PastryWasteDaily(ormar.Model):
+    """
+    Model representing the pastry_waste_daily table: the pastries wasted by
+    every sales outlet per day, materialized after every ingest (see app.aggregates).
+
+    Attributes:
+        id (int): The unique identifier for the row (primary key).
+        sales_date (datetime.date): The day.
+        sales_outlet_id (int): The identifier for the sales outlet.
+        week_desc (str): The week label, from the dates calendar.
+        start_of_day (int): The pastries in stock when the day started.
+        quantity_sold (int): The pastries sold.
+        waste (int): The pastries left at the end of the day.
+        waste_percent (float): The share of the stock wasted, in percent.
+    """
+    class Meta(BaseMeta):
+        tablename = 'pastry_waste_daily'
+        constraints = [ormar.UniqueColumns('sales_date', 'sales_outlet_id')]
+
+    id = ormar.Integer(primary_key=True)
+    sales_date = ormar.Date()
+    sales_outlet_id = ormar.Integer()
+    week_desc = ormar.String(max_length=20)
+    start_of_day = ormar.Integer()
+    quantity_sold = ormar.Integer()
+    waste = ormar.Integer()
+    waste_percent = ormar.Float(nullable=True)
+
+
+class CustomerRfm(ormar.Model):
+    """
+    Model representing the customer_rfm table: the recency, frequency and
+    monetary value of every customer's orders, scored against the other
+    customers and labelled with a segment, computed in batches (see app.rfm).
+
+    Attributes:
+        customer_id (int): The identifier for the customer (primary key).
+        first_order_date (datetime.date): The date of the customer's first order.
+        last_order_date (datetime.date): The date of the customer's last order.
+        recency_days (int): The days from the last order to the latest order of any customer.
+        frequency (int): The number of orders.
+        monetary (float): The amount of the line items ordered.
+        r_score (int): The recency score, from 1 (least recent fifth) to 5.
+        f_score (int): The frequency score, from 1 to 5.
+        m_score (int): The monetary score, from 1 to 5.
+        segment (str): The segment label, see app.common.CustomerSegment.
+    """
+    class Meta(BaseMeta):
+        tablename = 'customer_rfm'
+        constraints = [
+            # customers of a segment, paged by id
+            ormar.IndexColumns('segment', 'customer_id'),
+            # minimum spend
+            ormar.IndexColumns('monetary'),
+            # inactivity window
+            ormar.IndexColumns('recency_days'),
+        ]
+
+    customer_id = ormar.Integer(primary_key=True, autoincrement=False)
+    first_order_date = ormar.Date()
+    last_order_date = ormar.Date()
+    recency_days = ormar.Integer(nullable=True)
+    frequency = ormar.Integer()
+    monetary = ormar.Float()
+    r_score = ormar.SmallInteger(nullable=True)
+    f_score = ormar.SmallInteger(nullable=True)
+    m_score = ormar.SmallInteger(nullable=True)
+    segment = ormar.String(max_length=20, nullable=True)
+
+
+class IngestState(ormar.Model):
+    """
+    Model representing the ingest_state table, one row per loaded CSV file.
+
+    Attributes:
+        file_name (str): The name of the CSV file (primary key).
+        table_name (str): The table the file is loaded into.
+        content_hash (str): The SHA-256 of the file content at the last load.
+        size_bytes (int): The size of the file at the last load.
+        row_count (int): The number of data rows loaded from the file.
+        high_water_mark (datetime.datetime): The latest transaction_datetime loaded, if any.
+        loaded_at (datetime.datetime): When the file was last loaded.
+        rows_loaded (int): The number of rows the last load added.
+        load_seconds (float): The duration of the last load.
+    """
+    class Meta(BaseMeta):
+        tablename = 'ingest_state'
+
+    file_name = ormar.String(primary_key=True, max_length=255)
+    table_name = ormar.String(max_length=100)
+    content_hash = ormar.String(max_length=64)
+    size_bytes = ormar.BigInteger()
+    row_count = ormar.Integer()
+    high_water_mark = ormar.DateTime(nullable=True)
+    loaded_at = ormar.DateTime()
+    rows_loaded = ormar.Integer(nullable=True)
+    load_seconds = ormar.Float(nullable=True)
+
+
+def month_start(day: datetime.date) -> datetime.date:
+    """
+    Return the first day of the month of a date.
+    """
+    return datetime.date(day.year, day.month, 1)
+
+
+def partition_name(tablename: str, month: datetime.date) -> str:
+    """
+    Return the name of the partition of a table for a month, e.g. sales_reciepts_2019_04.
+    """
+    return f'{tablename}_{month:%Y_%m}'
+
+
+def partitions_query(tablename: str) -> str:
+    """
+    Return the query listing the names of the partitions of a table.
+    """
+    return f'''SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = '{tablename}'::regclass'''
+
+
+def partition_statements(tablename: str, month: datetime.date) -> list:
+    """
+    Return the statements creating the partition of a table for a month.
+
+    The partition is created on its own and then attached, which unlike
+    CREATE TABLE ... PARTITION OF does not lock out the queries and writes
+    running on the table.
+
+    Args:
+        tablename (str): The partitioned table.
+        month (datetime.date): The first day of the month.
+
+    Returns:
+        list: The SQL statements, to be run in order.
+    """
+    name = partition_name(tablename, month)
+    stop = month_start(month + datetime.timedelta(days=31))
+    return [f'CREATE TABLE {name} (LIKE {tablename} INCLUDING DEFAULTS)',
+            f"ALTER TABLE {tablename} ATTACH PARTITION {name} FOR VALUES FROM ('{month}') TO ('{stop}')"]
+
+
+def partition_existing(connection: object, tablename: str, column: str) -> None:
+    """
+    Convert a table created before it was partitioned into a partitioned one,
+    keeping its rows and its id sequence.
+
+    Args:
+        connection (object): A connection of the database engine, in a transaction.
+        tablename (str): The table to convert.
+        column (str): The partition key column.
+    """
+    old = f'{tablename}_unpartitioned'
+    execute = lambda sql: connection.execute(sqlalchemy.text(sql))
+    execute(f'ALTER TABLE {tablename} RENAME TO {old}')
+    execute(f'ALTER TABLE {old} RENAME CONSTRAINT {tablename}_pkey TO {old}_pkey')
+    execute(f'CREATE TABLE {tablename} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})')
+    execute(f'ALTER SEQUENCE {tablename}_id_seq OWNED BY {tablename}.id')
+    months = execute(f'SELECT DISTINCT CAST(date_trunc(\'month\', {column}) AS DATE) FROM {old}').scalars().all()
+    for month in months:
+        for statement in partition_statements(tablename, month):
+            execute(statement)
+    execute(f'INSERT INTO {tablename} SELECT * FROM {old}')
+    execute(f'ALTER TABLE {tablename} ADD PRIMARY KEY (id, {column})')
+    # Its indexes go along; migrate creates them on the partitioned table.
+    execute(f'DROP TABLE {old}')
+
+
+def migrate(engine: object) -> list:
+    """
+    Bring the database schema up to date with the models.
+
+    Missing tables are created, and missing columns and indexes are added to
+    existing tables. The ingest state of tables that got new columns is
+    cleared, so their files are reloaded and the new columns filled. Tables
+    created before they were partitioned are converted, see partition_existing.
+
+    Args:
+        engine (object): The database engine object.
+
+    Returns:
+        list: The names of the tables that got new columns.
+    """
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for tablename, column in monthly_partitions.items():
+            kind = connection.execute(sqlalchemy.text('SELECT relkind FROM pg_class WHERE oid = CAST(:name AS regclass)'),
+                                      {'name': tablename}).scalar()
+            if kind == 'r':
+                partition_existing(connection, tablename, column)
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    altered = []
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(sqlalchemy.text(
+                        f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}'))
+                    if table.name not in altered:
+                        altered.append(table.name)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        if altered:
+            ingest_state = IngestState.Meta.table
+            connection.execute(ingest_state.delete().where(ingest_state.c.table_name.in_(altered)))
+    return altered
+
+
+def create_schema(db_url: str = None) -> list:
+    """
+    Create the database if it does not exist and bring its schema up to date.
+
+    Run by `python -m app.ingest`, never on import: the API processes only
+    connect, so any number of workers can start side by side.
+
+    Args:
+        db_url (str): The database URL; defaults to settings.db_url.
+
+    Returns:
+        list: The names of the tables that got new columns, see migrate.
+    """
+    engine = sqlalchemy.create_engine(db_url or settings.db_url)
+    try:
+        if not database_exists(engine.url):
+            create_database(engine.url)
+        return migrate(engine)
+    finally:
+        engine.dispose()
@@ -0,0 +1,138 @@
+# app/derived.py
+
+from .db import CustomerLastOrder, CustomerRfmState, ProductSalesDaily, Sales
+
+# Statements that fold a staged batch of new rows (the `{batch}` table) into
+# the tables derived from a source table.
+PRODUCT_SALES_DAILY_REFRESH = '''INSERT INTO product_sales_daily (sales_date, product_id, sales_outlet_id, quantity, line_item_amount, line_items)
+                    SELECT transaction_date, product_id, sales_outlet_id, SUM(quantity), SUM(line_item_amount), COUNT(*)
+                    FROM {batch}
+                    GROUP BY transaction_date, product_id, sales_outlet_id
+                    ON CONFLICT (sales_date, product_id, sales_outlet_id) DO UPDATE
+                    SET quantity = product_sales_daily.quantity + EXCLUDED.quantity,
+                        line_item_amount = product_sales_daily.line_item_amount + EXCLUDED.line_item_amount,
+                        line_items = product_sales_daily.line_items + EXCLUDED.line_items;
+                        '''
+
+CUSTOMER_LAST_ORDER_REFRESH = '''INSERT INTO customer_last_order (customer_id, last_order_datetime, last_transaction_id)
+                    SELECT DISTINCT ON (customer_id) customer_id, transaction_datetime, transaction_id
+                    FROM {batch}
+                    WHERE transaction_datetime IS NOT NULL
+                    ORDER BY customer_id, transaction_datetime DESC, transaction_id DESC
+                    ON CONFLICT (customer_id) DO UPDATE
+                    SET last_order_datetime = EXCLUDED.last_order_datetime,
+                        last_transaction_id = EXCLUDED.last_transaction_id
+                    WHERE EXCLUDED.last_order_datetime >= customer_last_order.last_order_datetime;
+                        '''
+
+# Rows are locked in customer order, so batches written concurrently do not
+# deadlock. Anonymous receipts (customer 0) belong to no customer.
+CUSTOMER_RFM_STATE_REFRESH = '''INSERT INTO customer_rfm_state (customer_id, changes)
+                    SELECT customer_id, 1
+                    FROM {batch}
+                    WHERE customer_id <> 0
+                    GROUP BY customer_id
+                    ORDER BY customer_id
+                    ON CONFLICT (customer_id) DO UPDATE
+                    SET changes = customer_rfm_state.changes + 1;
+                        '''
+
+# The derived tables of every source table, with the statement refreshing each.
+derived_tables = {
+    Sales.Meta.tablename: [(ProductSalesDaily, PRODUCT_SALES_DAILY_REFRESH),
+                           (CustomerLastOrder, CUSTOMER_LAST_ORDER_REFRESH),
+                           (CustomerRfmState, CUSTOMER_RFM_STATE_REFRESH)],
+}
+
+# Callables run with (table, columns, batch) after every loaded batch, e.g. to
+# invalidate in-process caches.
+load_listeners = []
+
+
+def has_derived(table: object) -> bool:
+    """
+    Tell whether tables derived from a table have to be refreshed when it is loaded.
+
+    Args:
+        table (object): The source table object.
+
+    Returns:
+        bool: True if the table has derived tables.
+    """
+    return table.Meta.tablename in derived_tables
+
+
+async def copy_batch(raw_connection: object, table: object, columns: list, batch: list) -> None:
+    """
+    Load a batch of records into a table and refresh its derived tables in one transaction.
+
+    The batch is copied into a temporary staging table first, so the derived
+    tables are refreshed from the new rows only.
+
+    Args:
+        raw_connection (object): The asyncpg connection.
+        table (object): The source table object.
+        columns (list): The column names, in the order of the record values.
+        batch (list): The records (tuples) to load.
+
+    Returns:
+        None
+    """
+    tablename = table.Meta.tablename
+    staging = f'{tablename}_batch'
+    async with raw_connection.transaction():
+        await raw_connection.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} '
+                                     f'(LIKE {tablename} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+        await raw_connection.copy_records_to_table(staging, records=batch, columns=columns)
+        await raw_connection.execute(f'INSERT INTO {tablename} SELECT * FROM {staging}')
+        for derived, refresh in derived_tables[tablename]:
+            await raw_connection.execute(refresh.format(batch=staging))
+        # ON COMMIT does not apply when the load runs inside an outer transaction.
+        await raw_connection.execute(f'TRUNCATE {staging}')
+
+
+async def reset_derived(table: object) -> None:
+    """
+    Empty the tables derived from a table, before it is reloaded from scratch.
+
+    Args:
+        table (object): The source table object.
+
+    Returns:
+        None
+    """
+    for derived, refresh in derived_tables.get(table.Meta.tablename, []):
+        await derived.objects.delete(each=True)
+
+
+async def backfill_derived(table: object) -> None:
+    """
+    Build the derived tables of a table that are still empty from all of its rows,
+    e.g. when a derived table is added to a database that is already loaded.
+
+    Args:
+        table (object): The source table object.
+
+    Returns:
+        None
+    """
+    tablename = table.Meta.tablename
+    for derived, refresh in derived_tables.get(tablename, []):
+        if not await derived.objects.exists() and await table.objects.exists():
+            await table.Meta.database.execute(refresh.format(batch=tablename))
+
+
+def notify_loaded(table: object, columns: list, batch: list) -> None:
+    """
+    Run the load listeners for a batch that was loaded into a table.
+
+    Args:
+        table (object): The table object the batch was loaded into.
+        columns (list): The column names, in the order of the record values.
+        batch (list): The loaded records.
+
+    Returns:
+        None
+    """
+    for listener in load_listeners:
+        listener(table, columns, batch)
@@ -0,0 +1,362 @@
+# app/ingest.py
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+import sys
+import time
+from typing import Optional
+
+from . import metrics
+from .cache import bump_generation
+from .common import load_table
+from .config import settings
+from .derived import backfill_derived, reset_derived
+from .aggregates import refresh_aggregates
+from .db import (Customer, Dates, Generation, IngestState, PastryInventory, Product, Sales, SalesOutlet, SalesTarget,
+                 Staff, create_schema, database, spawn_task)
+from .partitions import is_partitioned
+from .rfm import refresh_customer_rfm
+from .snapshot import file_hash
+
+logger = logging.getLogger(__name__)
+
+# The dataset files, by table, in the order they are ingested.
+DATASET_FILES = ((Customer, 'customer.csv'), (Product, 'product.csv'), (Dates, 'Dates.csv'),
+                 (Sales, 'sales_reciepts.csv'), (SalesOutlet, 'sales_outlet.csv'), (Staff, 'staff.csv'),
+                 (Generation, 'generations.csv'), (SalesTarget, 'sales targets.csv'),
+                 (PastryInventory, 'pastry inventory.csv'))
+
+# Ingests notify this channel with the table name once a file is committed,
+# so API processes invalidate their caches.
+INGEST_CHANNEL = 'ingest'
+
+
+async def notify_ingest(database: object, name: str) -> None:
+    """
+    Notify the API processes on INGEST_CHANNEL that a table, or the aggregates, changed.
+
+    Args:
+        database (object): The database connection pool.
+        name (str): The name of the table or of the group of tables.
+    """
+    await database.execute('SELECT pg_notify(:channel, :table)', values={'channel': INGEST_CHANNEL, 'table': name})
+
+class TableProgress:
+    """
+    The progress of ingesting one file into a table.
+
+    Attributes:
+        file_name (str): The name of the file.
+        status (str): pending, loading, skipped (unchanged file), loaded or failed.
+        rows_loaded (int): The rows loaded so far.
+        bytes_read (int): The bytes of the file read so far.
+        size_bytes (int): The size of the file.
+        seconds (float): The time spent so far.
+        error (str): The error that made the ingest fail, if any.
+    """
+    def __init__(self, csv_file: str, size_bytes: Optional[int] = None):
+        self.file_name = os.path.basename(csv_file)
+        self.status = 'pending'
+        self.rows_loaded = 0
+        self.bytes_read = 0
+        self.size_bytes = os.path.getsize(csv_file) if size_bytes is None else size_bytes
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('skipped', 'loaded')
+
+    def start(self) -> None:
+        self.status = 'loading'
+        self.started = time.perf_counter()
+
+    def update(self, rows_loaded: int, bytes_read: int) -> None:
+        self.rows_loaded = rows_loaded
+        self.bytes_read = bytes_read
+
+    def finish(self, status: str, error: str = None) -> None:
+        self.status = status
+        self.error = error
+        self.finished = time.perf_counter()
+        if status != 'failed':
+            self.bytes_read = self.size_bytes
+
+    def as_dict(self) -> dict:
+        """
+        Return the progress as a JSON-serializable dict.
+        """
+        seconds = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        return {'file_name': self.file_name, 'status': self.status, 'rows_loaded': self.rows_loaded,
+                'bytes_read': self.bytes_read, 'size_bytes': self.size_bytes,
+                'percent': round(100 * self.bytes_read / self.size_bytes, 1) if self.size_bytes else 100.0,
+                'seconds': round(seconds, 3), 'error': self.error}
+
+
+# The progress of the current or last ingest, by table name.
+ingest_progress = {}
+
+
+async def high_water_mark(table: object) -> datetime.datetime:
+    """
+    Return the latest transaction_datetime of a table, or None if it has no such column.
+
+    Args:
+        table (object): The table object.
+
+    Returns:
+        datetime.datetime: The high-water mark.
+    """
+    if 'transaction_datetime' not in table.__fields__:
+        return None
+    # objects.max() aggregates over a subquery ordered by the primary key, which
+    # reads every row; a plain MAX is read off the transaction_datetime index.
+    return await table.Meta.database.fetch_val(f'SELECT MAX(transaction_datetime) FROM {table.Meta.tablename}')
+
+
+async def ingest_file(table: object, csv_file: str, progress: Optional[TableProgress] = None) -> int:
+    """
+    Load a CSV file into a table unless it has already been loaded.
+
+    The state of every loaded file is kept in the ingest_state table:
+      - an unchanged file is skipped,
+      - a file that grew by appending rows only has its new rows loaded,
+      - any other change reloads the table from scratch.
+    Tables derived from the table are refreshed along with it. The load is
+    one transaction, except for partitioned tables loaded by several workers
+    (settings.ingest_workers), which commit every batch.
+
+    Args:
+        table (object): The table object to load the data into.
+        csv_file (str): The path to the CSV file.
+        progress (TableProgress): Updated as the file is loaded.
+
+    Returns:
+        int: The number of rows loaded.
+    """
+    progress = progress or TableProgress(csv_file)
+    progress.start()
+    file_name = os.path.basename(csv_file)
+    size_bytes = os.path.getsize(csv_file)
+    state = await IngestState.objects.get_or_none(file_name=file_name)
+    prefix_size = state.size_bytes if state and state.size_bytes <= size_bytes else None
+    content_hash, prefix_hash = file_hash(csv_file, prefix_size)
+
+    if state and state.content_hash == content_hash:
+        logger.info('Skipping %s: unchanged since %s', file_name, state.loaded_at)
+        await backfill_derived(table)
+        progress.finish('skipped')
+        return 0
+
+    workers = settings.ingest_workers if is_partitioned(table) else 1
+    # Parallel writers commit batch by batch on their own connections, so
+    # their load cannot be one transaction.
+    async with IngestState.Meta.database.transaction() if workers == 1 else contextlib.nullcontext():
+        if state and prefix_hash == state.content_hash:
+            logger.info('Appending new rows of %s after row %d', file_name, state.row_count)
+            skip_rows = state.row_count
+        else:
+            if state:
+                logger.info('Reloading %s: content changed', file_name)
+            await table.objects.delete(each=True)
+            await reset_derived(table)
+            skip_rows = 0
+        if workers > 1 and state:
+            # Forget the file until it is loaded, so an interrupted load is
+            # redone from scratch rather than appended to.
+            await state.delete()
+            state = None
+
+        started = time.perf_counter()
+        loaded = await load_table(table, csv_file, skip_rows=skip_rows, progress=progress.update,
+                                  content_hash=content_hash, workers=workers)
+        values = dict(
+            table_name=table.Meta.tablename,
+            content_hash=content_hash,
+            size_bytes=size_bytes,
+            row_count=skip_rows + loaded,
+            high_water_mark=await high_water_mark(table),
+            loaded_at=datetime.datetime.now(),
+            rows_loaded=loaded,
+            load_seconds=time.perf_counter() - started,
+        )
+        if state:
+            await state.update(**values)
+        else:
+            await IngestState.objects.create(file_name=file_name, **values)
+    # Readers, in this process and others, may have cached data read before the commit.
+    bump_generation()
+    await notify_ingest(IngestState.Meta.database, table.Meta.tablename)
+    progress.finish('loaded')
+    return loaded
+
+
+async def ingest_files(files: list) -> bool:
+    """
+    Ingest files into their tables concurrently, tracking progress in ingest_progress.
+
+    The tables are independent, so each file is loaded by its own task on its
+    own pooled connection. A failing file is logged and does not stop the others.
+    The aggregates are rebuilt, and customer_rfm refreshed, once every file is done.
+
+    Args:
+        files (list): The (table object, CSV file path) pairs.
+
+    Returns:
+        bool: True if every file was ingested and the aggregates and customer_rfm refreshed.
+    """
+    ingest_progress.clear()
+    for table, csv_file in files:
+        ingest_progress[table.Meta.tablename] = TableProgress(csv_file)
+
+    async def ingest(table: object, csv_file: str) -> None:
+        progress = ingest_progress[table.Meta.tablename]
+        try:
+            await ingest_file(table, csv_file, progress=progress)
+        except Exception as error:
+            logger.exception('Ingest of %s failed', csv_file)
+            progress.finish('failed', error=f'{type(error).__name__}: {error}')
+
+    tasks = [spawn_task(ingest(table, csv_file)) for table, csv_file in files]
+    await asyncio.gather(*tasks)
+    try:
+        await ingest_aggregates()
+        await ingest_customer_rfm()
+    except Exception:
+        logger.exception('Refreshing the aggregates failed')
+        return False
+    return all(progress.done for progress in ingest_progress.values())
+
+
+async def ingest_aggregates() -> None:
+    """
+    Rebuild the aggregates the outlet reports are served from (see
+    app.aggregates) from the ingested tables, and notify the API processes.
+    """
+    started = time.perf_counter()
+    async with IngestState.Meta.database.connection() as connection:
+        await refresh_aggregates(connection.raw_connection)
+    logger.info('Refreshed the aggregates in %.2fs', time.perf_counter() - started)
+    bump_generation()
+    await notify_ingest(IngestState.Meta.database, 'aggregates')
+
+
+async def ingest_customer_rfm() -> int:
+    """
+    Compute customer_rfm for the customers whose receipts changed (see
+    app.rfm), and notify the API processes if any did.
+
+    Returns:
+        int: The number of customers computed.
+    """
+    computed = await refresh_customer_rfm(IngestState.Meta.database)
+    if computed:
+        bump_generation()
+        await notify_ingest(IngestState.Meta.database, 'customer_rfm')
+    return computed
+
+
+async def read_ingest_state(files: list) -> bool:
+    """
+    Fill ingest_progress, and the ingest metrics, from the ingest_state table,
+    for processes that serve the data ingested by another one.
+
+    Args:
+        files (list): The (table object, CSV file path) pairs.
+
+    Returns:
+        bool: True if every file has been ingested.
+    """
+    states = {state.file_name: state for state in await IngestState.objects.all()}
+    progress = {}
+    for table, csv_file in files:
+        state = states.get(os.path.basename(csv_file))
+        progress[table.Meta.tablename] = table_progress = TableProgress(csv_file, size_bytes=state.size_bytes if state else 0)
+        if state:
+            table_progress.update(state.row_count, state.size_bytes)
+            table_progress.status = 'loaded'
+            if state.load_seconds is not None:
+                metrics.observe_load(table.Meta.tablename, state.rows_loaded, state.load_seconds)
+    ingest_progress.clear()
+    ingest_progress.update(progress)
+    return all(table_progress.done for table_progress in progress.values())
+
+
+def dataset_files(directory: str) -> list:
+    """
+    Return the (table object, CSV file path) pairs of the dataset in a directory.
+    """
+    return [(table, os.path.join(directory, file_name)) for table, file_name in DATASET_FILES]
+
+
+async def run(directory: str) -> bool:
+    """
+    Ingest the dataset in a directory into the database, logging the outcome per table.
+
+    Args:
+        directory (str): The directory holding the CSV files.
+
+    Returns:
+        bool: True if every file was ingested.
+    """
+    await database.connect()
+    try:
+        ingested = await ingest_files(dataset_files(directory))
+    finally:
+        await database.disconnect()
+    for tablename, progress in ingest_progress.items():
+        logger.info('%s: %s, %d rows in %.2fs%s', tablename, progress.status, progress.rows_loaded,
+                    progress.as_dict()['seconds'], f' ({progress.error})' if progress.error else '')
+    return ingested
+
+
+async def run_customer_rfm() -> int:
+    """
+    Refresh customer_rfm alone, e.g. for the receipts posted since the last ingest.
+
+    Returns:
+        int: The number of customers computed.
+    """
+    await database.connect()
+    try:
+        return await ingest_customer_rfm()
+    finally:
+        await database.disconnect()
+
+
+def main(argv: Optional[list] = None) -> int:
+    """
+    Create or migrate the schema and ingest the dataset, before starting the API.
+
+    Usage:
+        python -m app.ingest [--dataset-dir DIR] [--migrate-only | --rfm-only]
+
+    Returns:
+        int: The exit status, 1 if a file failed to load.
+    """
+    parser = argparse.ArgumentParser(prog='python -m app.ingest', description=main.__doc__.strip().splitlines()[0])
+    parser.add_argument('--dataset-dir', default=settings.dataset_dir, help='The directory holding the CSV files.')
+    parser.add_argument('--migrate-only', action='store_true', help='Only create or migrate the schema.')
+    parser.add_argument('--rfm-only', action='store_true',
+                        help='Only refresh customer_rfm for the customers whose receipts changed.')
+    arguments = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    altered = create_schema()
+    if altered:
+        logger.info('Added columns to %s', ', '.join(altered))
+    if arguments.migrate_only:
+        return 0
+    if arguments.rfm_only:
+        asyncio.run(run_customer_rfm())
+        return 0
+    return 0 if asyncio.run(run(arguments.dataset_dir)) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
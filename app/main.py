@@ -1,20 +1,46 @@
 # # app/main.py
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Path, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import asyncio
 import os
-from fastapi.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
+import time
+from datetime import date
+from typing import Optional
 
 
-from sqlalchemy_utils import database_exists, create_database, drop_database
-
-from app.db import database, engine, metadata, Customer, Sales, Product
-from app.common import load_table, get_birthday_customer, last_order_per_customer, top_selling_products
+from app.config import settings
+from app.db import database
+from app import metrics
+from app.cache import cached_response
+from app.backends import make_backend
+from app.common import MAX_YEAR, MIN_YEAR, CustomerSegment, Granularity, TargetCategory, local_today
+from app.ingest import dataset_files, ingest_progress
+from app.receipts import QueueFull, ReceiptError, ReceiptWriter, read_receipts
 
 
 HOME = os.path.abspath(os.path.dirname(__file__))
 
 
 app = FastAPI(title="Coffee shop - FastAPI and Docker")
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Starts the backend on startup, in the background.
+start_task = None
+
+# The largest page of /customers/last-order-per-customer; larger exports stream NDJSON.
+MAX_PAGE_SIZE = 10000
+NDJSON = 'application/x-ndjson'
+
+# Answers the endpoint queries, see settings.backend.
+backend = make_backend(database)
+
+# Writes the receipts posted to /sales/receipts, with the postgres backend.
+receipt_writer = None
+
+metrics.Gauge('receipt_queue_rows', 'Posted receipt line items waiting to be written.',
+              function=lambda: {(): receipt_writer.pending_rows} if receipt_writer is not None else {})
+metrics.Gauge('db_pool_connections', 'Connections of the database pool by state.', ('state',),
+              function=lambda: metrics.pool_connections(database))
 
 @app.get("/")
 def read_root():
@@ -28,47 +54,250 @@ def read_root():
 
 
 @app.get("/customers/birthday")
-async def read_birthday():
+async def read_birthday(request: Request):
     """
-    API endpoint to retrieve customers with birthdays today.
+    API endpoint to retrieve the customers visiting the shop today who have their birthday.
 
     Returns:
-        JSONResponse: A JSON response containing the customer information.
+        Response: A JSON response containing the customer information.
     """
-    birthday = await get_birthday_customer(Customer)
-    customer_dict = {'customer': birthday } 
-    content = jsonable_encoder(customer_dict)
-    return JSONResponse(content=content)
+    today = local_today()
+
+    async def build():
+        birthday = await backend.get_birthday_customer(today=today)
+        return {'customer': birthday }
+
+    return await cached_response(request, ('birthday', today), build)
 
 @app.get("/products/top-selling-products/{year}")
-async def read_last_order(year: int):
+async def read_last_order(request: Request, year: int = Path(..., ge=MIN_YEAR, le=MAX_YEAR),
+                          start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          outlet_id: Optional[int] = None, product_category: Optional[str] = None,
+                          granularity: Optional[Granularity] = None):
     """
     API endpoint to retrieve the top selling products for a specific year.
 
     Args:
         year (int): The year to filter the sales receipts.
+        start_date (date): Only count sales on or after this date.
+        end_date (date): Only count sales on or before this date.
+        outlet_id (int): Only count sales of this sales outlet.
+        product_category (str): Only count products of this category.
+        granularity (Granularity): Return the top selling products per week, month or quarter.
 
     Returns:
-        JSONResponse: A JSON response containing the top selling products.
+        Response: A JSON response containing the top selling products.
     """
-    products = await top_selling_products(year, engine)
-    customer_dict = {'products': products} 
-    content = jsonable_encoder(customer_dict)
-    return JSONResponse(content=content)
+    async def build():
+        products = await backend.top_selling_products(year, start_date=start_date, end_date=end_date,
+                                                      outlet_id=outlet_id, product_category=product_category,
+                                                      granularity=granularity)
+        return {'products': products}
+
+    key = ('top-selling-products', year, start_date, end_date, outlet_id, product_category, granularity)
+    return await cached_response(request, key, build)
 
 
 @app.get("/customers/last-order-per-customer")
-async def read_last_order():
+async def read_last_order(request: Request, after_customer_id: Optional[int] = None,
+                          limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
     """
     API endpoint to retrieve the last order per customer.
 
+    Pages are keyset-based: pass the next_after_customer_id of a page as the
+    after_customer_id of the next one. With `Accept: application/x-ndjson`,
+    the customers are streamed one JSON object per line instead, for exports
+    of any size.
+
+    Args:
+        after_customer_id (int): Only return the customers with a greater id.
+        limit (int): Return at most this many customers.
+
+    Returns:
+        Response: A JSON response containing the customer's last order information,
+        and next_after_customer_id when a limit is given, or the NDJSON stream.
+    """
+    if NDJSON in request.headers.get('accept', ''):
+        return StreamingResponse(backend.stream_last_order_per_customer(after_customer_id=after_customer_id, limit=limit),
+                                 media_type=NDJSON)
+
+    async def build():
+        last_order = await backend.last_order_per_customer(after_customer_id=after_customer_id, limit=limit)
+        if limit is None:
+            return {'customers': last_order }
+        # A short page is the last one.
+        next_after = last_order[-1]['customer_id'] if len(last_order) == limit else None
+        return {'customers': last_order, 'next_after_customer_id': next_after}
+
+    return await cached_response(request, ('last-order-per-customer', after_customer_id, limit), build)
+
+
+@app.get("/customers/rfm")
+async def read_customer_rfm(request: Request, segment: Optional[CustomerSegment] = None,
+                            min_monetary: Optional[float] = None, inactive_days: Optional[int] = Query(None, ge=0),
+                            after_customer_id: Optional[int] = None,
+                            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    API endpoint to retrieve the recency, frequency and monetary value of the
+    customers, with their RFM scores and segment, for retargeting campaigns.
+
+    Pages are keyset-based, like /customers/last-order-per-customer.
+
+    Args:
+        segment (CustomerSegment): Only return the customers of this segment.
+        min_monetary (float): Only return the customers who spent at least this amount.
+        inactive_days (int): Only return the customers who did not order for at least this many days.
+        after_customer_id (int): Only return the customers with a greater id.
+        limit (int): Return at most this many customers.
+
+    Returns:
+        Response: A JSON response containing the customers, and next_after_customer_id
+        when a limit is given.
+    """
+    if not backend.uses_database:
+        raise HTTPException(status_code=501, detail='Customer RFM is only served with the postgres backend')
+
+    async def build():
+        customers = await backend.customer_rfm(segment=segment, min_monetary=min_monetary, inactive_days=inactive_days,
+                                               after_customer_id=after_customer_id, limit=limit)
+        if limit is None:
+            return {'customers': customers}
+        next_after = customers[-1]['customer_id'] if len(customers) == limit else None
+        return {'customers': customers, 'next_after_customer_id': next_after}
+
+    key = ('customer-rfm', segment, min_monetary, inactive_days, after_customer_id, limit)
+    return await cached_response(request, key, build)
+
+
+@app.get("/outlets/sales-vs-target/{year}")
+async def read_sales_vs_target(request: Request, year: int = Path(..., ge=MIN_YEAR, le=MAX_YEAR),
+                               month: Optional[int] = Query(None, ge=1, le=12),
+                               outlet_id: Optional[int] = None, category: Optional[TargetCategory] = None):
+    """
+    API endpoint to retrieve the units sold by every sales outlet per month and
+    target category, against the goals of sales targets.csv.
+
+    Args:
+        year (int): The year of the months.
+        month (int): Only return this month of the year.
+        outlet_id (int): Only return this sales outlet.
+        category (TargetCategory): Only return this category.
+
+    Returns:
+        Response: A JSON response containing the sales and goals per outlet, month and category.
+    """
+    if not backend.uses_database:
+        raise HTTPException(status_code=501, detail='Outlet reports are only served with the postgres backend')
+
+    async def build():
+        outlets = await backend.outlet_sales_vs_target(year, month=month, outlet_id=outlet_id, category=category)
+        return {'outlets': outlets}
+
+    return await cached_response(request, ('sales-vs-target', year, month, outlet_id, category), build)
+
+
+@app.get("/outlets/pastry-waste")
+async def read_pastry_waste(request: Request, start_date: Optional[date] = None, end_date: Optional[date] = None,
+                            outlet_id: Optional[int] = None):
+    """
+    API endpoint to retrieve the share of the pastries every sales outlet wasted per day.
+
+    Args:
+        start_date (date): Only return days on or after this date.
+        end_date (date): Only return days on or before this date.
+        outlet_id (int): Only return this sales outlet.
+
     Returns:
-        JSONResponse: A JSON response containing the customer's last order information.
+        Response: A JSON response containing the pastry stock, sales and waste per day and outlet.
+    """
+    if not backend.uses_database:
+        raise HTTPException(status_code=501, detail='Outlet reports are only served with the postgres backend')
+
+    async def build():
+        days = await backend.pastry_waste(start_date=start_date, end_date=end_date, outlet_id=outlet_id)
+        return {'days': days}
+
+    return await cached_response(request, ('pastry-waste', start_date, end_date, outlet_id), build)
+
+
+@app.post("/sales/receipts", status_code=201)
+async def create_receipts(request: Request):
+    """
+    API endpoint receiving receipt line items from the outlets, as NDJSON:
+    one sales_reciepts row per line, without id and transaction_datetime.
+
+    The line items are validated as the body is received, then queued and
+    written in micro-batches together with the derived tables. The response
+    is sent once they are committed.
+
+    Returns:
+        dict: The number of line items written. The status code is 422 if a
+        line is invalid, in which case nothing is written, and 503 with
+        Retry-After if too many line items are waiting to be written.
+    """
+    if receipt_writer is None:
+        raise HTTPException(status_code=501, detail='Receipts are only accepted with the postgres backend')
+    try:
+        records = await read_receipts(request.stream(), max_rows=receipt_writer.queue_size)
+    except ReceiptError as error:
+        raise HTTPException(status_code=422, detail=error.errors)
+    try:
+        written = await receipt_writer.submit(records)
+    except QueueFull as error:
+        raise HTTPException(status_code=503, detail=str(error), headers={'Retry-After': '1'})
+    return {'written': written}
+
+
+@app.get("/metrics")
+def read_metrics():
+    """
+    Endpoint exposing the service metrics in the Prometheus text format.
+
+    Returns:
+        Response: The metrics.
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/health/live")
+def read_live():
+    """
+    Liveness endpoint: the process is up and serving requests.
+
+    Returns:
+        dict: A dictionary with a "status" key.
+    """
+    return {'status': 'alive'}
+
+
+@app.get("/health/ready")
+def read_ready():
+    """
+    Readiness endpoint: every dataset file has been ingested.
+
+    Returns:
+        JSONResponse: The status (ready, loading or failed) and the ingest progress
+        per table, with status code 503 until the service is ready.
+    """
+    tables = {name: progress.as_dict() for name, progress in ingest_progress.items()}
+    start_failed = start_task is not None and start_task.done() and start_task.exception() is not None
+    if start_failed or any(table['status'] == 'failed' for table in tables.values()):
+        status = 'failed'
+    elif start_task is not None and start_task.done() and all(progress.done for progress in ingest_progress.values()):
+        status = 'ready'
+    else:
+        status = 'loading'
+    return JSONResponse(content={'status': status, 'tables': tables}, status_code=200 if status == 'ready' else 503)
+
+
+async def start_backend():
+    """
+    Start the backend: follow the ingests into the database, or load the
+    dataset into the in-memory store, depending on the backend.
     """
-    last_order = await last_order_per_customer(engine)
-    customers = {'customers': last_order } 
-    content = jsonable_encoder(customers)
-    return JSONResponse(content=content)
+    started = time.perf_counter()
+    await backend.start(dataset_files(settings.dataset_dir))
+    metrics.startup_phase_duration.set(time.perf_counter() - started, 'backend')
 
 
 @app.on_event("startup")
@@ -76,15 +305,20 @@ async def startup():
     """
     Event function that runs on application startup.
 
-    It establishes a connection to the database and loads the table data.
+    It only connects to the database and starts the backend in the
+    background; the schema and the data are set up beforehand by
+    `python -m app.ingest`, so any number of workers can start at once.
+    /health/ready reports whether the dataset is available.
     """
-    if not database.is_connected:
+    global start_task, receipt_writer
+    started = time.perf_counter()
+    if backend.uses_database and not database.is_connected:
         await database.connect()
-    # create a dummy entry
-    await load_table(Customer, csv_file=os.path.join(HOME,'..', 'dataset', 'customer.csv'))
-    await load_table(Product, csv_file=os.path.join(HOME,'..', 'dataset', 'product.csv'))
-    await load_table(Sales, csv_file=os.path.join(HOME,'..', 'dataset', 'sales_reciepts.csv'))
-    
+    metrics.startup_phase_duration.set(time.perf_counter() - started, 'connect')
+    if backend.uses_database:
+        receipt_writer = ReceiptWriter(database)
+        receipt_writer.start()
+    start_task = asyncio.create_task(start_backend())
 
 
 @app.on_event("shutdown")
@@ -92,7 +326,17 @@ async def shutdown():
     """
     Event function that runs on application shutdown.
 
-    It disconnects from the database.
+    It stops a running backend start, writes the queued receipts and
+    disconnects from the database.
     """
+    if start_task is not None and not start_task.done():
+        start_task.cancel()
+        try:
+            await start_task
+        except asyncio.CancelledError:
+            pass
+    await backend.stop()
+    if receipt_writer is not None:
+        await receipt_writer.close()
     if database.is_connected:
-        await database.disconnect()
\ No newline at end of file
+        await database.disconnect()
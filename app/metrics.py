@@ -0,0 +1,261 @@
+# app/metrics.py
+
+import bisect
+import time
+from typing import Callable, Optional, Sequence
+
+# Upper bounds, in seconds, of the latency histogram buckets. Cached responses
+# take well under a millisecond, so the buckets start lower than Prometheus'
+# defaults.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Starlette appends the charset to text/ media types.
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Every metric, in the order they are exposed.
+registry = []
+
+
+def escape(value: str) -> str:
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    """
+    Format label names and values as `{name="value",...}`, or '' when there are none.
+    """
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    """
+    Format a sample value for the Prometheus text format.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named metric with labelled samples, registered for exposition on creation.
+
+    Updates are plain dict and list operations without locks: the application
+    updates metrics from a single event loop.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The HELP text.
+        labelnames (tuple): The names of the labels, in the order their values are passed.
+        function (Callable): If given, returns {label values: value} when the metric is scraped,
+            for values kept elsewhere.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], dict]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {}
+        registry.append(self)
+
+    def samples(self) -> list:
+        """
+        Return the (suffix, label values, extra label, value) of every sample.
+        """
+        values = self.function() if self.function is not None else self.values
+        return [('', labels, '', value) for labels, value in values.items()]
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labelnames, labels, extra)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing count.
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+
+class Timer:
+    """
+    Context manager observing the seconds spent in its block into a histogram.
+    """
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: 'Histogram', labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram(Metric):
+    """
+    Observations counted into cumulative buckets, with their sum and count.
+
+    Attributes:
+        buckets (tuple): The bucket upper bounds, in increasing order.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        """
+        Count an observation.
+
+        Args:
+            value (float): The observed value.
+            *labels: The label values.
+        """
+        state = self.values.get(labels)
+        if state is None:
+            # Per-bucket (non-cumulative) counts, the +Inf bucket last, then the sum.
+            state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def time(self, *labels) -> Timer:
+        """
+        Return a context manager observing the duration of its block.
+        """
+        return Timer(self, labels)
+
+    def samples(self) -> list:
+        samples = []
+        for labels, state in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                samples.append(('_bucket', labels, f'le="{format_value(float(bound))}"', cumulative))
+            samples.append(('_sum', labels, '', state[-1]))
+            samples.append(('_count', labels, '', cumulative))
+        return samples
+
+
+def pool_connections(database: object) -> dict:
+    """
+    Read the connection counts of a connected database's asyncpg pool.
+
+    Args:
+        database (object): The databases.Database.
+
+    Returns:
+        dict: The number of connections by (state,): open, idle, in_use and max.
+    """
+    pool = getattr(getattr(database, '_backend', None), '_pool', None)
+    if pool is None:
+        return {}
+    size, idle = pool.get_size(), pool.get_idle_size()
+    return {('open',): size, ('idle',): idle, ('in_use',): size - idle, ('max',): pool.get_max_size()}
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every HTTP request into http_request_duration.
+
+    Requests are labelled with the path template of the route that handled
+    them, e.g. /products/top-selling-products/{year}, so the number of series
+    stays bounded.
+    """
+    def __init__(self, app: Callable):
+        self.app = app
+        self.route_paths = {}
+
+    def route(self, scope: dict) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        path = self.route_paths.get(endpoint)
+        if path is None:
+            routes = getattr(scope.get('app'), 'routes', [])
+            self.route_paths.update({route.endpoint: route.path for route in routes if hasattr(route, 'endpoint')})
+            path = self.route_paths.setdefault(endpoint, getattr(endpoint, '__name__', 'unknown'))
+        return path
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_status(message: dict) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            http_request_duration.observe(time.perf_counter() - started, scope['method'], self.route(scope), str(status))
+
+
+def observe_load(tablename: str, rows: int, seconds: float) -> None:
+    """
+    Record the rows and duration of the last load of a table.
+
+    Set by the process that loads the table, and by the API processes from
+    the ingest_state table, since `python -m app.ingest` serves no metrics.
+    """
+    ingest_rows.set(rows, tablename)
+    ingest_duration.set(seconds, tablename)
+    ingest_rows_per_second.set(rows / seconds if seconds else 0, tablename)
+
+
+def render() -> str:
+    """
+    Render every registered metric in the Prometheus text format.
+
+    Returns:
+        str: The exposition text.
+    """
+    return ''.join(metric.render() for metric in registry)
+
+
+http_request_duration = Histogram('http_request_duration_seconds', 'HTTP request latency by route.',
+                                  ('method', 'route', 'status'))
+query_duration = Histogram('query_duration_seconds', 'Time spent in SQL by named query.', ('query',))
+response_encode_duration = Histogram('response_encode_duration_seconds',
+                                     'Time spent encoding response payloads to JSON by endpoint.', ('endpoint',))
+ingest_rows = Gauge('ingest_rows_loaded', 'Rows of the last load by table.', ('table',))
+ingest_duration = Gauge('ingest_duration_seconds', 'Duration of the last load by table.', ('table',))
+ingest_rows_per_second = Gauge('ingest_rows_per_second', 'Throughput of the last load by table.', ('table',))
+startup_phase_duration = Gauge('startup_phase_duration_seconds', 'Duration of each startup phase.', ('phase',))
@@ -0,0 +1,89 @@
+# app/partitions.py
+
+import datetime
+import itertools
+import logging
+from typing import Iterator
+
+import asyncpg
+
+from .db import month_start, monthly_partitions, partition_name, partition_statements, partitions_query
+
+logger = logging.getLogger(__name__)
+
+
+def is_partitioned(table: object) -> bool:
+    """
+    Tell whether a table is range-partitioned by month, see app.db.partition_by_month.
+    """
+    return table.Meta.tablename in monthly_partitions
+
+
+def batch_months(table: object, columns: list, batch: list) -> set:
+    """
+    Return the months (first days) of the partition key values of a batch of records.
+
+    Args:
+        table (object): The partitioned table object.
+        columns (list): The column names, in the order of the record values.
+        batch (list): The records.
+
+    Returns:
+        set: The months.
+    """
+    index = columns.index(monthly_partitions[table.Meta.tablename])
+    return {month_start(day) for day in {record[index] for record in batch}}
+
+
+def split_by_month(table: object, columns: list, records: list) -> Iterator[tuple]:
+    """
+    Split records into runs of the same month of the partition key.
+
+    Files are mostly in date order, so a chunk usually splits into one or two runs.
+
+    Args:
+        table (object): The partitioned table object.
+        columns (list): The column names, in the order of the record values.
+        records (list): The records.
+
+    Returns:
+        Iterator[tuple]: The month and the list of its records, per run.
+    """
+    index = columns.index(monthly_partitions[table.Meta.tablename])
+    for (year, month), run in itertools.groupby(records, key=lambda record: (record[index].year, record[index].month)):
+        yield datetime.date(year, month, 1), list(run)
+
+
+async def ensure_partitions(raw_connection: object, table: object, months: set) -> None:
+    """
+    Create the partitions of a table that are missing for some months.
+
+    Partitions are created on a separate connection, committed before the
+    batch that needs them is written, so a long ingest transaction does not
+    hold them back from other writers. An advisory lock keeps concurrent
+    writers from creating the same partition.
+
+    Args:
+        raw_connection (object): The asyncpg connection the batch is written with.
+        table (object): The partitioned table object.
+        months (set): The months (first days) the batch holds.
+
+    Returns:
+        None
+    """
+    tablename = table.Meta.tablename
+    existing = {row[0] for row in await raw_connection.fetch(partitions_query(tablename))}
+    if all(partition_name(tablename, month) in existing for month in months):
+        return
+    connection = await asyncpg.connect(str(table.Meta.database.url))
+    try:
+        async with connection.transaction():
+            await connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', tablename)
+            existing = {row[0] for row in await connection.fetch(partitions_query(tablename))}
+            for month in sorted(months):
+                if partition_name(tablename, month) not in existing:
+                    logger.info('Creating partition %s', partition_name(tablename, month))
+                    for statement in partition_statements(tablename, month):
+                        await connection.execute(statement)
+    finally:
+        await connection.close()
@@ -0,0 +1,366 @@
+# app/receipts.py
+
+import asyncio
+import datetime
+import json
+import logging
+import math
+from typing import AsyncIterator, Callable, Optional
+
+import sqlalchemy
+
+from . import metrics
+from .common import write_batch
+from .config import settings
+from .aggregates import refresh_aggregates
+from .db import OutletSalesMonthly, Sales, month_start, spawn_task
+from .ingest import notify_ingest
+from .partitions import batch_months
+
+logger = logging.getLogger(__name__)
+
+# The line item fields a receipt carries; transaction_datetime is derived from
+# the date and time, and id is assigned by the database.
+RECEIPT_FIELDS = tuple(column.name for column in Sales.Meta.table.columns
+                       if column.name not in ('id', 'transaction_datetime'))
+# The columns of the records written to sales_reciepts, in order.
+RECEIPT_COLUMNS = RECEIPT_FIELDS + ('transaction_datetime',)
+
+# The validation errors reported for one request, at most.
+MAX_ERRORS = 20
+
+# The longest receipt line accepted, in bytes; a line item takes about 300.
+MAX_LINE_BYTES = 16 * 1024
+
+INTEGER_BOUNDS = {
+    sqlalchemy.SmallInteger: (-2 ** 15, 2 ** 15 - 1),
+    sqlalchemy.BigInteger: (-2 ** 63, 2 ** 63 - 1),
+    sqlalchemy.Integer: (-2 ** 31, 2 ** 31 - 1),
+}
+
+
+class ReceiptError(ValueError):
+    """
+    Raised when a request body holds invalid receipts.
+
+    Attributes:
+        errors (list): The errors, as dicts with the line number, the field and a message.
+    """
+    def __init__(self, errors: list):
+        super().__init__(f'{len(errors)} invalid receipt line(s)')
+        self.errors = errors
+
+
+class QueueFull(Exception):
+    """
+    Raised when the receipt queue had no room for a request's rows within the timeout.
+    """
+
+
+def field_converter(column: sqlalchemy.Column) -> Callable:
+    """
+    Build the function checking and converting the JSON value of a column.
+
+    The checks are strict and cheap: integers must be JSON integers within
+    the column's range, numbers finite, dates and times ISO-8601 strings,
+    strings within the column's length.
+
+    Args:
+        column (sqlalchemy.Column): The sales_reciepts column.
+
+    Returns:
+        Callable: Takes the JSON value and returns the column value, raises ValueError when invalid.
+    """
+    python_type = column.type.python_type
+    if python_type is int:
+        low, high = next(bounds for kind, bounds in INTEGER_BOUNDS.items() if isinstance(column.type, kind))
+
+        def convert(value):
+            if type(value) is not int:
+                raise ValueError('expected an integer')
+            if not low <= value <= high:
+                raise ValueError('integer out of range')
+            return value
+    elif python_type is float:
+        def convert(value):
+            if type(value) not in (int, float):
+                raise ValueError('expected a number')
+            if not math.isfinite(value):
+                raise ValueError('expected a finite number')
+            return float(value)
+    elif python_type in (datetime.date, datetime.time):
+        parse = python_type.fromisoformat
+
+        def convert(value):
+            if type(value) is not str:
+                raise ValueError(f'expected an ISO-8601 {python_type.__name__}')
+            return parse(value)
+    else:
+        length = getattr(column.type, 'length', None)
+
+        def convert(value):
+            if type(value) is not str:
+                raise ValueError('expected a string')
+            if length is not None and len(value) > length:
+                raise ValueError(f'longer than {length} characters')
+            return value
+    return convert
+
+
+# (field, converter, default) per receipt field; fields with a default of None are required.
+receipt_fields = [(name, field_converter(Sales.Meta.table.columns[name]), Sales.__fields__[name].default)
+                  for name in RECEIPT_FIELDS]
+
+
+def receipt_record(values: dict) -> tuple:
+    """
+    Validate one receipt line item and convert it to a sales_reciepts record.
+
+    Args:
+        values (dict): The decoded JSON object.
+
+    Returns:
+        tuple: The values of RECEIPT_COLUMNS.
+
+    Raises:
+        ValueError: With the field name and the message as arguments.
+    """
+    record = []
+    for name, convert, default in receipt_fields:
+        value = values.get(name)
+        if value is None:
+            if default is None:
+                raise ValueError(name, 'field required')
+            record.append(default)
+            continue
+        try:
+            record.append(convert(value))
+        except ValueError as error:
+            raise ValueError(name, str(error)) from None
+    record.append(datetime.datetime.combine(record[1], record[2]))
+    return tuple(record)
+
+
+async def read_receipts(chunks: AsyncIterator[bytes], max_rows: int) -> list:
+    """
+    Decode and validate an NDJSON body of receipt line items as it is received.
+
+    Blank lines are ignored. Nothing is accepted from a body with an invalid
+    line. Lines longer than MAX_LINE_BYTES are rejected as soon as they pass
+    the limit, so that a body without newlines is not buffered whole.
+
+    Args:
+        chunks (AsyncIterator[bytes]): The body, e.g. Request.stream().
+        max_rows (int): The most line items a body may hold.
+
+    Returns:
+        list: The sales_reciepts records.
+
+    Raises:
+        ReceiptError: If a line is invalid, or the body holds no line items or more than max_rows.
+    """
+    records, errors = [], []
+    line_number = 0
+    rest = b''
+
+    def too_long() -> dict:
+        return {'line': line_number, 'field': None, 'error': f'longer than {MAX_LINE_BYTES} bytes'}
+
+    def add(line: bytes) -> None:
+        if len(line) > MAX_LINE_BYTES:
+            errors.append(too_long())
+            return
+        if not line.strip():
+            return
+        try:
+            values = json.loads(line)
+            if not isinstance(values, dict):
+                raise ValueError(None, 'expected a JSON object')
+            records.append(receipt_record(values))
+        except json.JSONDecodeError as error:
+            errors.append({'line': line_number, 'field': None, 'error': f'invalid JSON: {error.msg}'})
+        except UnicodeDecodeError as error:
+            errors.append({'line': line_number, 'field': None, 'error': f'invalid JSON: {error.reason}'})
+        except ValueError as error:
+            field, message = error.args
+            errors.append({'line': line_number, 'field': field, 'error': message})
+
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            line_number += 1
+            add(line)
+        if len(rest) > MAX_LINE_BYTES:
+            line_number += 1
+            errors.append(too_long())
+            raise ReceiptError(errors[:MAX_ERRORS])
+        if len(errors) >= MAX_ERRORS:
+            raise ReceiptError(errors[:MAX_ERRORS])
+        if len(records) > max_rows:
+            raise ReceiptError([{'line': line_number, 'field': None, 'error': f'more than {max_rows} line items'}])
+    line_number += 1
+    add(rest)
+    if errors:
+        raise ReceiptError(errors[:MAX_ERRORS])
+    if not records:
+        raise ReceiptError([{'line': line_number, 'field': None, 'error': 'no line items'}])
+    if len(records) > max_rows:
+        raise ReceiptError([{'line': line_number, 'field': None, 'error': f'more than {max_rows} line items'}])
+    return records
+
+
+class ReceiptWriter:
+    """
+    Writes submitted receipts to sales_reciepts in micro-batches.
+
+    Submissions wait in a queue bounded by rows. A single writer task takes
+    them off the queue and coalesces them into one batch until it holds
+    batch_size rows or batch_delay seconds passed since its first rows, then
+    writes the batch and refreshes the derived tables in one transaction
+    (write_batch, which also creates missing partitions), invalidates the
+    caches and notifies the other processes.
+    A submission returns once its rows are committed.
+
+    Attributes:
+        database (object): The database connection pool.
+        batch_size (int): The rows after which a batch is written without waiting.
+        batch_delay (float): The seconds a batch waits for more rows at most.
+        queue_size (int): The rows that may wait in the queue at most.
+        queue_timeout (float): The seconds a submission waits for room in the queue at most.
+        pending_rows (int): The rows submitted and not written yet.
+    """
+    def __init__(self, database: object, batch_size: Optional[int] = None, batch_delay: Optional[float] = None,
+                 queue_size: Optional[int] = None, queue_timeout: Optional[float] = None):
+        self.database = database
+        self.batch_size = batch_size or settings.receipt_batch_size
+        self.batch_delay = settings.receipt_batch_delay if batch_delay is None else batch_delay
+        self.queue_size = queue_size or settings.receipt_queue_size
+        self.queue_timeout = settings.receipt_queue_timeout if queue_timeout is None else queue_timeout
+        self.pending_rows = 0
+        self.queue = asyncio.Queue()
+        self.room = asyncio.Event()
+        self.task = None
+
+    def start(self) -> None:
+        """
+        Start the writer task.
+        """
+        self.task = spawn_task(self.run())
+
+    async def close(self) -> None:
+        """
+        Write the queued receipts and stop the writer task.
+        """
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def submit(self, records: list) -> int:
+        """
+        Queue receipt records and wait until they are committed.
+
+        Args:
+            records (list): The sales_reciepts records, see read_receipts.
+
+        Returns:
+            int: The number of records written.
+
+        Raises:
+            QueueFull: If the queue had no room for the records within queue_timeout.
+        """
+        if not records:
+            return 0
+        if len(records) > self.queue_size:
+            raise QueueFull(f'{len(records)} rows do not fit in a queue of {self.queue_size}')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        while self.pending_rows + len(records) > self.queue_size:
+            self.room.clear()
+            try:
+                await asyncio.wait_for(self.room.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise QueueFull(f'{self.pending_rows} rows are waiting to be written') from None
+        self.pending_rows += len(records)
+        written = loop.create_future()
+        self.queue.put_nowait((records, written))
+        # The rows are written even if the request is cancelled meanwhile.
+        await asyncio.shield(written)
+        return len(records)
+
+    async def next_batch(self) -> tuple:
+        """
+        Wait for the next submissions and coalesce them into a batch.
+
+        Returns:
+            tuple: The records, the futures of their submissions, and whether the writer was closed.
+        """
+        loop = asyncio.get_running_loop()
+        batch, futures = [], []
+        item = await self.queue.get()
+        deadline = loop.time() + self.batch_delay
+        while item is not None:
+            records, written = item
+            batch.extend(records)
+            futures.append(written)
+            if len(batch) >= self.batch_size:
+                break
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+        return batch, futures, item is None
+
+    async def write(self, batch: list) -> None:
+        """
+        Write a batch and refresh the derived tables in one transaction, then
+        the monthly outlet sales of its months, invalidate the caches of this
+        process and notify the others.
+        """
+        with metrics.query_duration.time('write_receipts'):
+            async with self.database.connection() as connection:
+                await write_batch(connection.raw_connection, Sales, list(RECEIPT_COLUMNS), batch)
+                months = batch_months(Sales, RECEIPT_COLUMNS, batch)
+                await refresh_aggregates(connection.raw_connection, min(months),
+                                         month_start(max(months) + datetime.timedelta(days=31)),
+                                         tables=[OutletSalesMonthly])
+        await notify_ingest(self.database, Sales.Meta.tablename)
+
+    async def run(self) -> None:
+        """
+        Write batches until the writer is closed.
+        """
+        closed = False
+        while not closed:
+            batch, futures, closed = await self.next_batch()
+            if not batch:
+                for written in futures:
+                    if not written.done():
+                        written.set_result(None)
+                continue
+            try:
+                await self.write(batch)
+            except Exception as error:
+                logger.exception('Writing %d receipts failed', len(batch))
+                for written in futures:
+                    if not written.done():
+                        written.set_exception(error)
+            else:
+                receipts_written.inc(amount=len(batch))
+                for written in futures:
+                    if not written.done():
+                        written.set_result(None)
+            finally:
+                self.pending_rows -= len(batch)
+                self.room.set()
+
+
+receipts_written = metrics.Counter('receipts_written_total', 'Receipt line items written through POST /sales/receipts.')
@@ -0,0 +1,222 @@
+# app/rfm.py
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import time
+from typing import Optional
+
+import asyncpg
+import numpy
+import pandas
+
+from .common import CustomerSegment
+from .config import settings
+from .db import CustomerRfm
+
+logger = logging.getLogger(__name__)
+
+# Customers are split into shards of at least this many, one per worker
+# process at most; a single shard is computed in a thread instead.
+MIN_SHARD_CUSTOMERS = 1000
+
+# The customers whose receipts changed since customer_rfm was computed for them.
+PENDING_CUSTOMERS = '''SELECT customer_id, changes FROM customer_rfm_state
+                    WHERE changes <> computed_changes
+                    ORDER BY customer_id'''
+
+# The receipts of a shard of customers.
+SHARD_COLUMNS = ('customer_id', 'transaction_date', 'sales_outlet_id', 'transaction_id', 'line_item_amount')
+SHARD_RECEIPTS = f'''SELECT {', '.join(SHARD_COLUMNS)}
+                    FROM sales_reciepts
+                    WHERE customer_id = ANY($1::integer[])'''
+
+# An order is one transaction of an outlet on a day.
+ORDER_KEY = ['customer_id', 'transaction_date', 'sales_outlet_id', 'transaction_id']
+
+# The segments by RFM score; the first matching rule labels a customer.
+SEGMENT_RULES = (
+    (CustomerSegment.champions, 'r_score >= 4 AND f_score >= 4 AND m_score >= 4'),
+    (CustomerSegment.loyal, 'r_score >= 3 AND f_score >= 4'),
+    (CustomerSegment.new, 'r_score >= 4 AND f_score = 1'),
+    (CustomerSegment.promising, 'r_score >= 4'),
+    (CustomerSegment.need_attention, 'r_score = 3'),
+    (CustomerSegment.at_risk, 'f_score >= 3'),
+    (CustomerSegment.hibernating, 'r_score = 2'),
+    (CustomerSegment.lost, 'TRUE'),
+)
+
+
+def score(column: str) -> str:
+    """
+    Return the SQL expression scoring a column from 1 to 5 by the share of
+    customers with an equal or lower value, so that equal values get equal
+    scores and the customers tied on the highest value all score 5.
+    """
+    return f'CAST(CEIL(5 * CUME_DIST() OVER (ORDER BY {column})) AS SMALLINT)'
+
+
+def segment_case() -> str:
+    """
+    Return the SQL expression labelling a customer with its segment, from the r, f and m scores.
+    """
+    cases = ' '.join(f"WHEN {rule} THEN '{segment.value}'" for segment, rule in SEGMENT_RULES)
+    return f'CASE {cases} END'
+
+
+# The statements writing the measures of the pending customers, then scoring
+# every customer against the others. Recency is counted up to the latest order
+# of any customer, the end of the data.
+DELETE_CUSTOMERS = 'DELETE FROM customer_rfm WHERE customer_id = ANY($1::integer[])'
+MEASURE_COLUMNS = ['customer_id', 'first_order_date', 'last_order_date', 'frequency', 'monetary']
+# Customers whose receipts were reloaded away.
+DELETE_STALE = '''DELETE FROM customer_rfm r
+                    WHERE NOT EXISTS (SELECT 1 FROM customer_rfm_state s WHERE s.customer_id = r.customer_id)'''
+MARK_COMPUTED = '''UPDATE customer_rfm_state s SET computed_changes = c.changes
+                    FROM UNNEST($1::integer[], $2::integer[]) AS c (customer_id, changes)
+                    WHERE s.customer_id = c.customer_id'''
+RESCORE = '''WITH scores AS (
+                        SELECT customer_id,
+                               MAX(last_order_date) OVER () - last_order_date AS recency_days,
+                               {r_score} AS r_score, {f_score} AS f_score, {m_score} AS m_score
+                        FROM customer_rfm
+                    ), segments AS (
+                        SELECT *, {segment} AS segment FROM scores
+                    )
+                    UPDATE customer_rfm r
+                    SET recency_days = s.recency_days, r_score = s.r_score, f_score = s.f_score,
+                        m_score = s.m_score, segment = s.segment
+                    FROM segments s
+                    WHERE r.customer_id = s.customer_id
+                      AND (r.recency_days, r.r_score, r.f_score, r.m_score, r.segment)
+                          IS DISTINCT FROM (s.recency_days, s.r_score, s.f_score, s.m_score, s.segment)'''.format(
+    r_score=score('last_order_date'), f_score=score('frequency'), m_score=score('monetary'), segment=segment_case())
+
+
+def customer_measures(receipts: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Compute the first and last order date, the number of orders and the amount spent per customer.
+
+    Args:
+        receipts (pandas.DataFrame): The receipts, with the SHARD_RECEIPTS columns.
+
+    Returns:
+        pandas.DataFrame: One row per customer: customer_id, first_order_date,
+        last_order_date, frequency and monetary.
+    """
+    measures = receipts.groupby('customer_id').agg(first_order_date=('transaction_date', 'min'),
+                                                   last_order_date=('transaction_date', 'max'),
+                                                   monetary=('line_item_amount', 'sum'))
+    measures['frequency'] = receipts.drop_duplicates(ORDER_KEY).groupby('customer_id').size()
+    measures['monetary'] = measures['monetary'].round(2)
+    return measures.reset_index()[MEASURE_COLUMNS]
+
+
+async def shard_receipts(db_url: str, customer_ids: list) -> pandas.DataFrame:
+    """
+    Read the receipts of a shard of customers on a connection of its own.
+
+    The rows are copied out as CSV, which pandas parses much faster than it
+    builds a frame from fetched records.
+
+    Args:
+        db_url (str): The database URL.
+        customer_ids (list): The ids of the customers of the shard.
+
+    Returns:
+        pandas.DataFrame: The receipts, with the SHARD_COLUMNS.
+    """
+    buffer = io.BytesIO()
+    buffer.write((','.join(SHARD_COLUMNS) + '\n').encode())
+
+    async def write(data: bytes) -> None:
+        buffer.write(data)
+
+    connection = await asyncpg.connect(db_url)
+    try:
+        await connection.copy_from_query(SHARD_RECEIPTS, customer_ids, output=write, format='csv')
+    finally:
+        await connection.close()
+    buffer.seek(0)
+    return pandas.read_csv(buffer, parse_dates=['transaction_date'])
+
+
+def shard_measures(db_url: str, customer_ids: list) -> pandas.DataFrame:
+    """
+    Read the receipts of a shard of customers and compute their measures.
+
+    Run in the worker processes, or in a thread, so it runs its own event loop.
+
+    Args:
+        db_url (str): The database URL.
+        customer_ids (list): The ids of the customers of the shard.
+
+    Returns:
+        pandas.DataFrame: The measures, see customer_measures.
+    """
+    return customer_measures(asyncio.run(shard_receipts(db_url, customer_ids)))
+
+
+async def compute_measures(customer_ids: list, workers: int) -> pandas.DataFrame:
+    """
+    Compute the measures of customers, split into shards of consecutive ids
+    computed by a pool of worker processes, or in a thread for a single shard.
+
+    Args:
+        customer_ids (list): The ids of the customers, in ascending order.
+        workers (int): The worker processes, at most.
+
+    Returns:
+        pandas.DataFrame: The measures, see customer_measures.
+    """
+    shards = max(1, min(workers, len(customer_ids) // MIN_SHARD_CUSTOMERS))
+    if shards == 1:
+        return await asyncio.to_thread(shard_measures, settings.db_url, customer_ids)
+    loop = asyncio.get_running_loop()
+    # Forking would copy the event loop and the connection pool of this process.
+    with concurrent.futures.ProcessPoolExecutor(shards, mp_context=multiprocessing.get_context('spawn')) as pool:
+        frames = await asyncio.gather(*(loop.run_in_executor(pool, shard_measures, settings.db_url, shard.tolist())
+                                        for shard in numpy.array_split(numpy.array(customer_ids), shards)))
+    return pandas.concat(frames, ignore_index=True)
+
+
+async def refresh_customer_rfm(database: object, workers: Optional[int] = None) -> int:
+    """
+    Bring customer_rfm up to date with the receipts.
+
+    Only the customers whose receipts changed since they were last computed
+    (see customer_rfm_state, maintained with sales_reciepts) are read and
+    computed again. Their rows are then replaced, and every customer is
+    scored again, in one transaction. Receipts loaded meanwhile leave their
+    customers pending for the next refresh.
+
+    Args:
+        database (object): The database connection pool.
+        workers (int): The worker processes, settings.rfm_workers by default.
+
+    Returns:
+        int: The number of customers computed.
+    """
+    started = time.perf_counter()
+    pending = await database.fetch_all(PENDING_CUSTOMERS)
+    if not pending:
+        return 0
+    customer_ids = [row[0] for row in pending]
+    measures = await compute_measures(customer_ids, workers or settings.rfm_workers)
+    columns = (measures['customer_id'].tolist(), pandas.to_datetime(measures['first_order_date']).dt.date.tolist(),
+               pandas.to_datetime(measures['last_order_date']).dt.date.tolist(), measures['frequency'].tolist(),
+               measures['monetary'].tolist())
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        async with raw_connection.transaction():
+            await raw_connection.execute('SELECT pg_advisory_xact_lock(hashtext($1))', 'customer_rfm')
+            await raw_connection.execute(DELETE_CUSTOMERS, customer_ids)
+            await raw_connection.copy_records_to_table(CustomerRfm.Meta.tablename, records=list(zip(*columns)),
+                                                       columns=MEASURE_COLUMNS)
+            await raw_connection.execute(DELETE_STALE)
+            await raw_connection.execute(MARK_COMPUTED, customer_ids, [row[1] for row in pending])
+            await raw_connection.execute(RESCORE)
+    logger.info('Computed customer_rfm for %d customers in %.2fs', len(customer_ids), time.perf_counter() - started)
+    return len(customer_ids)
@@ -0,0 +1,196 @@
+# app/snapshot.py
+
+import datetime
+import glob
+import hashlib
+import logging
+import os
+from typing import Iterator, Optional
+
+import pandas
+import pyarrow
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Arrow types of the prepared columns, by the Python type of the table column.
+ARROW_TYPES = {
+    int: pyarrow.int64(),
+    float: pyarrow.float64(),
+    str: pyarrow.string(),
+    datetime.date: pyarrow.date32(),
+    datetime.datetime: pyarrow.timestamp('us'),
+    datetime.time: pyarrow.time64('us'),
+}
+
+
+def file_hash(csv_file: str, prefix_size: int = None) -> tuple:
+    """
+    Hash a file, optionally also hashing its first `prefix_size` bytes in the same pass.
+
+    Args:
+        csv_file (str): The path to the file.
+        prefix_size (int): The length of the prefix to hash, if any.
+
+    Returns:
+        tuple: The SHA-256 hex digest of the whole file and of the prefix (None if not requested).
+    """
+    digest = hashlib.sha256()
+    prefix_digest = None
+    with open(csv_file, 'rb') as source:
+        if prefix_size is not None:
+            remaining = prefix_size
+            while remaining:
+                block = source.read(min(HASH_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+            prefix_digest = digest.hexdigest()
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest(), prefix_digest
+
+
+def schema_fingerprint(sa_table: object) -> str:
+    """
+    Hash the names and types of the columns of a table.
+
+    Args:
+        sa_table (object): The sqlalchemy table.
+
+    Returns:
+        str: The hex digest, shortened.
+    """
+    columns = ';'.join(f'{column.name}:{column.type}' for column in sa_table.columns)
+    return hashlib.sha256(columns.encode()).hexdigest()[:16]
+
+
+class Snapshot:
+    """
+    The prepared frames of a CSV file, stored as an Arrow IPC file.
+
+    The snapshot is keyed by the table and its schema (see
+    schema_fingerprint), and by the name, the content hash and the
+    modification time of the source file, so any change to the file, or a
+    migration adding columns to the table, makes it stale. It is uncompressed so it can be memory-mapped: reading it costs
+    neither parsing nor a copy of the file in memory.
+
+    Attributes:
+        table (object): The table object the frames are prepared for.
+        csv_file (str): The path to the source CSV file.
+        path (str): The path to the snapshot file.
+    """
+    def __init__(self, table: object, csv_file: str, content_hash: str):
+        self.table = table
+        self.csv_file = csv_file
+        self.path = os.path.join(settings.snapshot_dir, f'{self.prefix}.{content_hash[:32]}.'
+                                                        f'{schema_fingerprint(table.Meta.table)}.'
+                                                        f'{os.stat(csv_file).st_mtime_ns}.arrow')
+
+    @property
+    def prefix(self) -> str:
+        return f'{self.table.Meta.tablename}.{os.path.basename(self.csv_file)}'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def read(self, batch_size: int, skip_rows: int = 0) -> Iterator[tuple]:
+        """
+        Memory-map the snapshot and yield its frames.
+
+        Args:
+            batch_size (int): The maximum number of rows per frame.
+            skip_rows (int): Number of rows at the start to skip.
+
+        Returns:
+            Iterator[tuple]: The prepared frames, each with the approximate
+            number of bytes of the source file read so far.
+        """
+        size_bytes = os.path.getsize(self.csv_file)
+        with pyarrow.memory_map(self.path) as source:
+            data = pyarrow.ipc.open_file(source).read_all().slice(skip_rows)
+            rows_read = skip_rows
+            for batch in data.to_batches(max_chunksize=batch_size):
+                rows_read += batch.num_rows
+                yield batch.to_pandas(date_as_object=False), size_bytes * rows_read // (skip_rows + data.num_rows)
+
+    def writer(self) -> 'SnapshotWriter':
+        return SnapshotWriter(self)
+
+    def evict_stale(self) -> None:
+        """
+        Delete the other snapshots of the same table and source file.
+        """
+        for path in glob.glob(os.path.join(glob.escape(settings.snapshot_dir), glob.escape(self.prefix) + '.*.arrow')):
+            if path != self.path:
+                logger.info('Evicting stale snapshot %s', path)
+                os.remove(path)
+
+
+class SnapshotWriter:
+    """
+    Writes prepared frames to a temporary file that replaces the snapshot on commit.
+    """
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self.temporary = f'{snapshot.path}.{os.getpid()}.tmp'
+        self.schema = None
+        self.writer = None
+
+    def write(self, frame: pandas.DataFrame) -> None:
+        """
+        Append a prepared frame.
+
+        Args:
+            frame (pandas.DataFrame): The frame, as returned by prepare_frame.
+        """
+        data = pyarrow.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            columns = self.snapshot.table.Meta.table.columns
+            # The pandas metadata restores dtypes such as Int64 when the snapshot is read.
+            self.schema = pyarrow.schema([(name, ARROW_TYPES[columns[name].type.python_type]) for name in frame.columns],
+                                         metadata=data.schema.metadata)
+            os.makedirs(settings.snapshot_dir, exist_ok=True)
+            self.writer = pyarrow.ipc.new_file(self.temporary, self.schema)
+        self.writer.write_table(data.cast(self.schema))
+
+    def commit(self) -> None:
+        """
+        Replace the snapshot with the written frames and evict the stale snapshots.
+        """
+        if self.writer is None:
+            return
+        self.writer.close()
+        os.replace(self.temporary, self.snapshot.path)
+        self.snapshot.evict_stale()
+
+    def abort(self) -> None:
+        """
+        Discard the written frames.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.temporary)
+
+
+def snapshot_for(table: object, csv_file: str, content_hash: Optional[str] = None) -> Optional[Snapshot]:
+    """
+    Return the snapshot of a CSV file, unless snapshots are disabled or the file is too small to need one.
+
+    Args:
+        table (object): The table object the file is loaded into.
+        csv_file (str): The path to the CSV file.
+        content_hash (str): The SHA-256 hex digest of the file, computed if not given.
+
+    Returns:
+        Snapshot: The snapshot, which may not exist yet, or None.
+    """
+    if not settings.snapshot_dir or os.path.getsize(csv_file) < settings.snapshot_min_bytes:
+        return None
+    if content_hash is None:
+        content_hash, prefix_hash = file_hash(csv_file)
+    return Snapshot(table, csv_file, content_hash)
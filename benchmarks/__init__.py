@@ -0,0 +1,6 @@
+# benchmarks/__init__.py
+"""
+Benchmarks of the coffee shop service against synthetic data at several scales.
+
+Run with `python -m benchmarks --help`.
+"""
@@ -0,0 +1,178 @@
+# benchmarks/generator.py
+"""
+Deterministic synthetic data shaped like the bundled dataset.
+
+The CSV files have the same headers and value formats as dataset/customer.csv,
+sales_reciepts.csv and Dates.csv. Products and the other reference files are
+the real ones; outlets, staff, prices, quantities, line items per transaction
+and the share of anonymous receipts follow the real receipts.
+"""
+import datetime
+import os
+import shutil
+
+import numpy
+import pandas
+
+DATASET = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'dataset'))
+# The files copied from the dataset as they are.
+REFERENCE_FILES = ('product.csv', 'sales_outlet.csv', 'staff.csv', 'generations.csv', 'sales targets.csv',
+                   'pastry inventory.csv')
+
+START_DATE = datetime.date(2019, 4, 1)
+# Line items per day and per customer in the real receipts.
+ROWS_PER_DAY = 1700
+ROWS_PER_CUSTOMER = 22
+CHUNK_ROWS = 1_000_000
+
+
+class Profile:
+    """
+    The value distributions of the real receipts the synthetic ones are drawn from.
+    """
+    def __init__(self, dataset: str = DATASET):
+        sales = pandas.read_csv(os.path.join(dataset, 'sales_reciepts.csv'))
+        self.products = sales['product_id'].value_counts(normalize=True).sort_index()
+        self.unit_price = sales.groupby('product_id')['unit_price'].agg(lambda prices: prices.mode()[0])
+        staff = sales.groupby(['sales_outlet_id', 'staff_id']).size()
+        self.staff = {outlet: staff[outlet] / staff[outlet].sum() for outlet in staff.index.levels[0]}
+        self.outlets = sales['sales_outlet_id'].value_counts(normalize=True).sort_index()
+        self.quantity = sales['quantity'].value_counts(normalize=True).sort_index()
+        self.instore = sales['instore_yn'].value_counts(normalize=True)
+        self.promo = sales['promo_item_yn'].value_counts(normalize=True)
+        self.anonymous = (sales['customer_id'] == 0).mean()
+        self.line_items = sales.groupby(['transaction_date', 'sales_outlet_id', 'transaction_id']).size()
+        self.line_items = self.line_items.clip(upper=4).value_counts(normalize=True).sort_index()
+
+
+def choice(rng: numpy.random.Generator, distribution: pandas.Series, size: int) -> numpy.ndarray:
+    """
+    Draw values from a distribution given as a Series of probabilities indexed by value.
+    """
+    return rng.choice(distribution.index.to_numpy(), size=size, p=distribution.to_numpy())
+
+
+def generate_customers(rng: numpy.random.Generator, profile: Profile, count: int, path: str) -> None:
+    """
+    Write `count` customers to a CSV file shaped like dataset/customer.csv.
+    """
+    customer_id = numpy.arange(1, count + 1)
+    birthdate = pandas.Timestamp('1950-01-01') + pandas.to_timedelta(rng.integers(0, 18250, count), unit='D')
+    customer_since = pandas.Timestamp('2017-01-01') + pandas.to_timedelta(rng.integers(0, 820, count), unit='D')
+    loyalty = rng.integers(0, 10 ** 10, count)
+    pandas.DataFrame({
+        'customer_id': customer_id,
+        'home_store': choice(rng, profile.outlets, count),
+        'customer_first-name': [f'Customer {number}' for number in customer_id],
+        'customer_email': [f'customer{number}@example.com' for number in customer_id],
+        'customer_since': customer_since.strftime('%Y-%m-%d'),
+        'loyalty_card_number': [f'{number:010d}'[:3] + '-' + f'{number:010d}'[3:6] + '-' + f'{number:010d}'[6:]
+                                for number in loyalty],
+        'birthdate': birthdate.strftime('%Y-%m-%d'),
+        'gender': rng.choice(['M', 'F', 'N'], count),
+        'birth_year': birthdate.year,
+    }).to_csv(path, index=False)
+
+
+def generate_sales(rng: numpy.random.Generator, profile: Profile, rows: int, customers: int, path: str) -> None:
+    """
+    Write `rows` line items to a CSV file shaped like dataset/sales_reciepts.csv,
+    in date order and in chunks of CHUNK_ROWS rows.
+    """
+    days = max(30, rows // ROWS_PER_DAY)
+    written = 0
+    transaction_id = 0
+    with open(path, 'w', newline='') as csv_file:
+        while written < rows:
+            count = min(CHUNK_ROWS, rows - written)
+            sizes = choice(rng, profile.line_items, count)
+            sizes = sizes[:numpy.searchsorted(numpy.cumsum(sizes), count) + 1]
+            transactions = len(sizes)
+            first_row = written + numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+            transaction_day = first_row * days // rows
+            seconds = numpy.sort(rng.integers(6 * 3600, 21 * 3600, transactions))
+            order = numpy.lexsort((seconds, transaction_day))
+            transaction_day, seconds = transaction_day[order], seconds[order]
+            outlet = choice(rng, profile.outlets, transactions)
+            staff = numpy.empty(transactions, dtype=int)
+            for sales_outlet_id, distribution in profile.staff.items():
+                at_outlet = outlet == sales_outlet_id
+                staff[at_outlet] = choice(rng, distribution, int(at_outlet.sum()))
+            customer = numpy.where(rng.random(transactions) < profile.anonymous, 0,
+                                   rng.integers(1, customers + 1, transactions))
+
+            item = numpy.repeat(numpy.arange(transactions), sizes)[:count]
+            line_item_id = numpy.arange(count) - numpy.repeat(first_row - written, sizes)[:count] + 1
+            product = choice(rng, profile.products, count)
+            quantity = choice(rng, profile.quantity, count)
+            unit_price = profile.unit_price.reindex(product).to_numpy()
+            moment = pandas.Timestamp(START_DATE) + pandas.to_timedelta(transaction_day[item], unit='D') \
+                + pandas.to_timedelta(seconds[item], unit='s')
+            pandas.DataFrame({
+                'transaction_id': transaction_id + 1 + item,
+                'transaction_date': moment.strftime('%Y-%m-%d'),
+                'transaction_time': moment.strftime('%H:%M:%S'),
+                'sales_outlet_id': outlet[item],
+                'staff_id': staff[item],
+                'customer_id': customer[item],
+                'instore_yn': choice(rng, profile.instore, transactions)[item],
+                'order': 1,
+                'line_item_id': line_item_id,
+                'product_id': product,
+                'quantity': quantity,
+                'line_item_amount': numpy.round(quantity * unit_price, 2),
+                'unit_price': unit_price,
+                'promo_item_yn': choice(rng, profile.promo, count),
+            }).to_csv(csv_file, index=False, header=written == 0, float_format='%.2f')
+            written += count
+            transaction_id += transactions
+
+
+def generate_dates(rows: int, path: str) -> None:
+    """
+    Write the calendar of the generated receipts to a CSV file shaped like dataset/Dates.csv.
+    """
+    days = pandas.date_range(START_DATE, periods=max(30, rows // ROWS_PER_DAY), freq='D')
+    pandas.DataFrame({
+        'transaction_date': [f'{day.month}/{day.day}/{day.year}' for day in days],
+        'Date_ID': days.strftime('%Y%m%d'),
+        'Week_ID': days.isocalendar().week.to_numpy(),
+        'Week_Desc': [f'Week {week}' for week in days.isocalendar().week],
+        'Month_ID': days.month,
+        'Month_Name': days.month_name(),
+        'Quarter_ID': days.quarter,
+        'Quarter_Name': [f'Q{quarter}' for quarter in days.quarter],
+        'Year_ID': days.year,
+    }).to_csv(path, index=False)
+
+
+def generate(rows: int, directory: str, seed: int = 0) -> str:
+    """
+    Generate customer.csv, sales_reciepts.csv and Dates.csv for `rows` receipts,
+    next to copies of the reference files.
+
+    The files are reused when `directory` already holds a complete set for the same rows and seed.
+
+    Args:
+        rows (int): The number of sales_reciepts line items.
+        directory (str): Where to write the files.
+        seed (int): The random seed.
+
+    Returns:
+        str: The directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for file_name in REFERENCE_FILES:
+        if not os.path.exists(os.path.join(directory, file_name)):
+            shutil.copy(os.path.join(DATASET, file_name), os.path.join(directory, file_name))
+    marker = os.path.join(directory, f'.complete-{rows}-{seed}')
+    if os.path.exists(marker):
+        return directory
+    rng = numpy.random.default_rng(seed)
+    profile = Profile()
+    customers = max(100, rows // ROWS_PER_CUSTOMER)
+    generate_customers(rng, profile, customers, os.path.join(directory, 'customer.csv'))
+    generate_sales(rng, profile, rows, customers, os.path.join(directory, 'sales_reciepts.csv'))
+    generate_dates(rows, os.path.join(directory, 'Dates.csv'))
+    open(marker, 'w').close()
+    return directory
@@ -0,0 +1,26 @@
+# benchmarks/ingest.py
+"""
+Throughput of loading the synthetic CSV files into an empty database.
+"""
+import time
+
+
+async def bench_ingest(directory: str) -> dict:
+    """
+    Ingest every file of a synthetic dataset with ingest_file and time each table.
+
+    Args:
+        directory (str): The directory holding the CSV files.
+
+    Returns:
+        dict: The rows, seconds and rows/s per table.
+    """
+    from app.ingest import dataset_files, ingest_file
+
+    results = {}
+    for table, csv_file in dataset_files(directory):
+        started = time.perf_counter()
+        rows = await ingest_file(table, csv_file)
+        seconds = time.perf_counter() - started
+        results[table.Meta.tablename] = {'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds}
+    return results
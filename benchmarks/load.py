@@ -0,0 +1,151 @@
+# benchmarks/load.py
+"""
+HTTP latency and throughput of the API under concurrent load.
+
+The API runs in a uvicorn subprocess; the load comes from a small asyncio
+HTTP/1.1 client that keeps one connection open per concurrent user.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from .timing import summarize
+
+HOME = os.path.abspath(os.path.dirname(__file__))
+
+ENDPOINTS = ('/customers/birthday',
+             '/products/top-selling-products/{year}',
+             '/products/top-selling-products/{year}?granularity=month',
+             '/customers/last-order-per-customer')
+
+
+class Connection:
+    """
+    A keep-alive HTTP/1.1 connection sending GET requests.
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def get(self, path: str) -> int:
+        """
+        Send a GET request and read the whole response.
+
+        Returns:
+            int: The status code.
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\n\r\n'.encode())
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        headers = dict(line.lower().split(': ', 1) for line in header_lines if line)
+        await self.reader.readexactly(int(headers.get('content-length', 0)))
+        return int(status_line.split()[1])
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+async def run_load(host: str, port: int, path: str, concurrency: int, duration: float) -> dict:
+    """
+    Send GET requests to one path from `concurrency` connections for `duration` seconds.
+
+    Returns:
+        dict: The latency summary, requests/s and the number of non-200 responses.
+    """
+    samples = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def user() -> None:
+        nonlocal errors
+        connection = Connection(host, port)
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                status = await connection.get(path)
+                samples.append(time.perf_counter() - started)
+                errors += status != 200
+        finally:
+            await connection.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return dict(summarize(samples), requests_per_second=len(samples) / elapsed, errors=errors)
+
+
+async def wait_until(host: str, port: int, path: str, server: subprocess.Popen, timeout: float) -> float:
+    """
+    Poll a path until the server answers it with 200.
+
+    Returns:
+        float: The seconds it took.
+    """
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if server.poll() is not None:
+            raise RuntimeError(f'uvicorn exited with status {server.returncode}')
+        connection = Connection(host, port)
+        try:
+            if await connection.get(path) == 200:
+                return time.perf_counter() - started
+        except OSError:
+            pass
+        finally:
+            await connection.close()
+        await asyncio.sleep(0.05)
+    raise TimeoutError(f'{path} did not answer within {timeout}s')
+
+
+async def bench_http(database_url: str, directory: str, year: int, concurrency: int, duration: float,
+                     port: int = 8765, workers: int = 1) -> dict:
+    """
+    Start app.main:app on the synthetic dataset and load every endpoint in turn.
+
+    The first request to each endpoint is timed on its own, so the load
+    measures the steady state rather than concurrent cache misses.
+
+    Args:
+        database_url (str): The database the API connects to.
+        directory (str): The synthetic dataset, already ingested into the database.
+        year (int): The year passed to the top selling products endpoint.
+        concurrency (int): The number of concurrent connections.
+        duration (float): The seconds each endpoint is loaded.
+        port (int): The port uvicorn listens on.
+        workers (int): The number of uvicorn workers.
+
+    Returns:
+        dict: The seconds until the API is live and ready, and per endpoint the first request time and the load summary.
+    """
+    host = '127.0.0.1'
+    environment = dict(os.environ, DATABASE_URL=database_url, DATASET_DIR=directory)
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', host, '--port', str(port),
+                              '--workers', str(workers), '--log-level', 'warning', '--no-access-log'],
+                             cwd=os.path.join(HOME, '..'), env=environment)
+    try:
+        started = time.perf_counter()
+        results = {'live_seconds': await wait_until(host, port, '/health/live', server, timeout=60)}
+        await wait_until(host, port, '/health/ready', server, timeout=3600)
+        results['ready_seconds'] = time.perf_counter() - started
+        results['endpoints'] = {}
+        for endpoint in ENDPOINTS:
+            path = endpoint.format(year=year)
+            connection = Connection(host, port)
+            started = time.perf_counter()
+            await connection.get(path)
+            first_request_ms = (time.perf_counter() - started) * 1000
+            await connection.close()
+            results['endpoints'][path] = dict(await run_load(host, port, path, concurrency, duration),
+                                              first_request_ms=first_request_ms)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
@@ -0,0 +1,51 @@
+# benchmarks/queries.py
+"""
+Latency of the endpoint functions of app/common.py, straight against the database.
+"""
+import datetime
+import time
+
+from .timing import summarize
+
+
+async def timed(call, repeat: int, before=None) -> dict:
+    """
+    Await `call()` `repeat` times after one warm-up call and summarize the latencies.
+    """
+    await call()
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+async def bench_queries(repeat: int) -> dict:
+    """
+    Time get_birthday_customer, top_selling_products and last_order_per_customer.
+
+    The birthday lookup is done for the last day of the data, with its
+    in-process cache cleared before each call.
+
+    Args:
+        repeat (int): The number of timed calls per query.
+
+    Returns:
+        dict: The latency summary per query.
+    """
+    import app.db as db
+    from app.common import birthday_cache, get_birthday_customer, last_order_per_customer, top_selling_products
+
+    last_day = await db.database.fetch_val('SELECT MAX(transaction_date) FROM sales_reciepts')
+    year = last_day.year if last_day else datetime.date.today().year
+    return {
+        'get_birthday_customer': await timed(lambda: get_birthday_customer(db.database, today=last_day),
+                                             repeat, before=birthday_cache.clear),
+        'top_selling_products': await timed(lambda: top_selling_products(year, db.database), repeat),
+        'top_selling_products_month': await timed(
+            lambda: top_selling_products(year, db.database, granularity='month'), repeat),
+        'last_order_per_customer': await timed(lambda: last_order_per_customer(db.database), repeat),
+    }
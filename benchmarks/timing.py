@@ -0,0 +1,23 @@
+# benchmarks/timing.py
+
+import statistics
+
+
+def summarize(seconds: list) -> dict:
+    """
+    Summarize latency samples.
+
+    Args:
+        seconds (list): The samples, in seconds.
+
+    Returns:
+        dict: The count, mean, p50, p95, p99 and max, in milliseconds.
+    """
+    ordered = sorted(seconds)
+
+    def percentile(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {'count': len(ordered), 'mean_ms': statistics.fmean(ordered) * 1000,
+            'p50_ms': percentile(0.50), 'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99),
+            'max_ms': ordered[-1] * 1000}